@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the benchmark suite, reporting ops/sec and p50/p99 latencies.
+
+    $ python -m benchmarks --save baseline.json
+    $ python -m benchmarks --baseline baseline.json
+
+With --baseline, exits with status 1 if any benchmark's ops/sec dropped by
+more than --threshold.
+"""
+from __future__ import print_function
+
+import argparse
+import sys
+
+from . import bench_file, bench_keys, bench_redis
+from .common import load, report, save
+
+SUITES = ['keys', 'file', 'redis']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks', description=__doc__.split('\n\n')[0])
+    parser.add_argument('suites', nargs='*', metavar='suite',
+                        help='suites to run, of %s (default: all)'
+                             % ', '.join(SUITES))
+    parser.add_argument('--number', type=int, default=10000,
+                        help='operations per benchmark')
+    parser.add_argument('--processes', type=int, default=8,
+                        help='concurrent processes of the file suite')
+    parser.add_argument('--redis-url',
+                        help='redis-server to run the redis suite against '
+                             '(default: an in-process fakeredis)')
+    parser.add_argument('--save', metavar='PATH',
+                        help='save the results as a baseline')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='ops/sec drop counted as a regression '
+                             '(default: 0.1)')
+    args = parser.parse_args(argv)
+
+    suites = args.suites or SUITES
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error('unknown suites: ' + ', '.join(sorted(unknown)))
+    results = []
+    if 'keys' in suites:
+        results += bench_keys.suite(args.number)
+    if 'file' in suites:
+        results += bench_file.suite(
+            args.processes, max(args.number // args.processes, 1))
+    if 'redis' in suites:
+        results += bench_redis.suite(args.redis_url, args.number)
+
+    baseline = load(args.baseline) if args.baseline else None
+    regressions = report(results, baseline, args.threshold)
+    if args.save:
+        save(results, args.save)
+    if regressions:
+        print('\nRegressed: ' + ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the File backend acquiring and releasing locks from many
+processes at once, on distinct keys and on a single contended key.
+"""
+from __future__ import print_function
+
+import multiprocessing
+import shutil
+import tempfile
+from timeit import default_timer as timer
+
+from celery_once.backends.file import File
+from celery_once.tasks import AlreadyQueued
+
+from .common import summarize
+
+
+def worker(location, settings, prefix, number, queue):
+    backend = File(dict(settings, location=location))
+    latencies = []
+    for i in range(number):
+        key = '%s%d' % (prefix, i) if prefix is not None else 'contended'
+        started = timer()
+        try:
+            backend.raise_or_lock(key, 60, token=str(i))
+        except AlreadyQueued:
+            pass
+        else:
+            backend.clear_lock(key, token=str(i))
+        latencies.append(timer() - started)
+    queue.put(latencies)
+
+
+def run_processes(name, settings, processes, number, contended):
+    location = tempfile.mkdtemp(prefix='celery_once_bench_')
+    try:
+        queue = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=worker, args=(
+                location, settings, None if contended else 'key%d-' % p,
+                number, queue))
+            for p in range(processes)]
+        started = timer()
+        for process in workers:
+            process.start()
+        latencies = []
+        for _ in workers:
+            latencies.extend(queue.get())
+        elapsed = timer() - started
+        for process in workers:
+            process.join()
+    finally:
+        shutil.rmtree(location)
+    return summarize(name, latencies, elapsed)
+
+
+def suite(processes=8, number=2000):
+    """
+    Returns the results of acquire + release cycles, from `processes`
+    processes doing `number` each.
+    """
+    results = []
+    for layout, settings in [('flat', {}), ('sharded', {'shard_depth': 2})]:
+        results.append(run_processes(
+            'file.%s.distinct' % layout, settings, processes, number, False))
+        results.append(run_processes(
+            'file.%s.contended' % layout, settings, processes, number, True))
+    return results
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Compares QueueOnce.get_key against the previous key generation
+(signature binding + queue_once_key) for a few argument shapes.
+
+    $ python -m benchmarks.bench_keys
+
+Also measures queue_once_key, force_string and get_key for the suite, see
+benchmarks/__main__.py.
+"""
+from __future__ import print_function
+
+import timeit
+
+from celery import Celery
+from celery_once import QueueOnce
+from celery_once.helpers import force_string, queue_once_key
+
+from .common import measure
+
+
+app = Celery()
+app.conf.ONCE = {
+    'backend': 'celery_once.backends.File',
+    'settings': {}
+}
+
+
+@app.task(name='bench.example', base=QueueOnce)
+def example(a, b=None, c=None):
+    pass
+
+
+SHAPES = {
+    'flat': ((1, 'abc'), {'c': 2.5}),
+    'nested': (
+        ({'user': {'id': 1, 'tags': ['a', 'b']}, 'flags': [{'x': 1}]},),
+        {'c': {'z': 1, 'y': [1, 2, {'k': 'v'}]}}
+    ),
+    'large-list': ((list(range(1000)),), {}),
+}
+
+
+def previous_get_key(task, args, kwargs):
+    call_args = task._get_call_args(args, kwargs)
+    return queue_once_key(task.name, call_args, task.once.get('keys', None))
+
+
+def suite(number=10000):
+    """
+    Returns the results of queue_once_key, force_string and get_key for
+    each argument shape.
+    """
+    results = []
+    for name, (args, kwargs) in sorted(SHAPES.items()):
+        loops = number if name != 'large-list' else number // 100
+        call_args = example._get_call_args(args, kwargs)
+        results.append(measure(
+            'keys.queue_once_key.' + name,
+            lambda _: queue_once_key(example.name, call_args), loops))
+        results.append(measure(
+            'keys.force_string.' + name,
+            lambda _: force_string(call_args), loops))
+        results.append(measure(
+            'keys.get_key.' + name,
+            lambda _: example.get_key(args, kwargs), loops))
+    return results
+
+
+def run(number=10000):
+    print('{:<12} {:>14} {:>14} {:>8}'.format(
+        'shape', 'previous (us)', 'get_key (us)', 'speedup'))
+    for name, (args, kwargs) in sorted(SHAPES.items()):
+        assert previous_get_key(example, args, kwargs) == \
+            example.get_key(args, kwargs)
+        loops = number if name != 'large-list' else number // 100
+        previous = min(timeit.repeat(
+            lambda: previous_get_key(example, args, kwargs),
+            number=loops, repeat=3)) / loops
+        current = min(timeit.repeat(
+            lambda: example.get_key(args, kwargs),
+            number=loops, repeat=3)) / loops
+        print('{:<12} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(
+            name, previous * 1e6, current * 1e6, previous / current))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the Redis backend acquiring, rejecting and clearing locks, against
+a redis-server or, without a url, an in-process fakeredis (which measures
+the backend's own overhead rather than the server's).
+"""
+from __future__ import print_function
+
+import uuid
+
+from celery_once.backends.redis import Redis
+from celery_once.tasks import AlreadyQueued
+
+from .common import measure
+
+
+def make_backend(url=None):
+    backend = Redis({'url': url or 'redis://localhost:6379/0'})
+    if url is None:
+        from fakeredis import FakeStrictRedis
+        backend._redis = FakeStrictRedis()
+    return backend
+
+
+def reject(backend, key):
+    try:
+        backend.raise_or_lock(key, 60)
+    except AlreadyQueued:
+        pass
+
+
+def suite(url=None, number=10000):
+    """
+    Returns the results of acquiring new keys, being rejected on a held key,
+    and clearing held keys.
+    """
+    backend = make_backend(url)
+    prefix = 'qo_bench_%s_' % uuid.uuid4().hex
+    keys = [prefix + str(i) for i in range(number)]
+    held = prefix + 'held'
+    backend.raise_or_lock(held, 60)
+    try:
+        return [
+            measure('redis.acquire',
+                    lambda i: backend.raise_or_lock(keys[i], 60), number),
+            measure('redis.reject', lambda _: reject(backend, held), number),
+            measure('redis.clear',
+                    lambda i: backend.clear_lock(keys[i]), number),
+            measure('redis.acquire_token',
+                    lambda i: backend.raise_or_lock(keys[i], 60, token='t'),
+                    number),
+            measure('redis.clear_token',
+                    lambda i: backend.clear_lock(keys[i], token='t'),
+                    number),
+        ]
+    finally:
+        backend.clear_lock(held)
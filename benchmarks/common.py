@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Measuring, reporting and comparing benchmark results.
+"""
+from __future__ import print_function
+
+import json
+from timeit import default_timer as timer
+
+
+def percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize(name, latencies, elapsed=None):
+    """
+    Returns the result of a benchmark, from the latency (in seconds) of each
+    of its operations and the time they took in all (their sum by default,
+    less with concurrent operations).
+    """
+    latencies = sorted(latencies)
+    if elapsed is None:
+        elapsed = sum(latencies)
+    return {
+        'name': name,
+        'ops': len(latencies),
+        'ops_per_sec': len(latencies) / elapsed,
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+    }
+
+
+def measure(name, func, number, setup=None):
+    """
+    Calls func `number` times, timing each call. `setup` is called (untimed)
+    before each call, and its return value passed on to func.
+    """
+    latencies = []
+    for i in range(number):
+        arg = setup(i) if setup is not None else i
+        started = timer()
+        func(arg)
+        latencies.append(timer() - started)
+    return summarize(name, latencies)
+
+
+def report(results, baseline=None, threshold=0.1):
+    """
+    Prints the results, compared with the baseline's if given. Returns the
+    names of the benchmarks whose ops/sec regressed by more than
+    `threshold` (a fraction) from the baseline.
+    """
+    baseline = dict((r['name'], r) for r in baseline or [])
+    regressions = []
+    print('{:<36} {:>12} {:>10} {:>10} {:>9}'.format(
+        'benchmark', 'ops/sec', 'p50 (us)', 'p99 (us)', 'change'))
+    for result in results:
+        change = ''
+        previous = baseline.get(result['name'])
+        if previous is not None:
+            ratio = result['ops_per_sec'] / previous['ops_per_sec'] - 1
+            change = '{:+.1%}'.format(ratio)
+            if ratio < -threshold:
+                regressions.append(result['name'])
+                change += ' !'
+        print('{:<36} {:>12.0f} {:>10.2f} {:>10.2f} {:>9}'.format(
+            result['name'], result['ops_per_sec'], result['p50_us'],
+            result['p99_us'], change))
+    return regressions
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Asyncio versions of QueueOnce's apply_async, see QueueOnce.aapply_async."""
+
+import asyncio
+import functools
+from time import time
+from timeit import default_timer as timer
+
+from celery import states
+from celery.result import EagerResult
+from celery.utils import uuid
+
+from .tasks import AlreadyQueued
+
+
+async def raise_or_lock(task, key, timeout, token, pending=False,
+                        once_config=None):
+    if once_config is None:
+        once_config = task.once_config
+    metrics = task._get_once_metrics(once_config)
+    try:
+        await _raise_or_lock_cached(
+            task, key, timeout, token, metrics, pending, once_config)
+    except AlreadyQueued as e:
+        if metrics is not None:
+            metrics.lock_rejected(task.name, key, e.countdown)
+        raise
+    if metrics is not None:
+        metrics.lock_acquired(task.name, key)
+
+
+async def _raise_or_lock_cached(task, key, timeout, token, metrics,
+                                pending=False, once_config=None):
+    # A rejection must reach the backend to mark the lock pending.
+    cache = None if pending else task._get_rejection_cache(once_config)
+    now = time()
+    if cache is not None:
+        rejection = cache.get(key, now)
+        if rejection is not None:
+            raise AlreadyQueued(rejection[0] - now, task_id=rejection[1])
+    backend = task._get_once_async_backend(once_config)
+    if metrics is not None:
+        started = timer()
+    try:
+        if backend is not None:
+            await task._get_raise_or_lock(backend, pending)(
+                key, timeout=timeout, token=token)
+        else:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, functools.partial(
+                task._get_raise_or_lock(
+                    task._get_once_backend(once_config), pending),
+                key, timeout=timeout, token=token))
+    except AlreadyQueued as e:
+        if cache is not None:
+            task._cache_rejection(cache, key, e, now, once_config)
+        raise
+    finally:
+        if metrics is not None:
+            metrics.observe(task.name, 'acquire', timer() - started)
+
+
+async def apply_async(task, args=None, kwargs=None, **options):
+    once_options = options.get('once', {})
+    once_graceful = once_options.get(
+        'graceful', task.once.get('graceful', False))
+
+    if options.get('retries'):
+        return task.apply_async(args, kwargs, **options)
+    once_config = task.once_config
+    once_timeout = task._get_once_timeout(options, once_config)
+    task._get_key_builder(once_config)
+    key = task._get_key_measured(
+        args, kwargs, task._get_once_metrics(once_config))
+    task_id = options.get('task_id') or uuid()
+    try:
+        await raise_or_lock(
+            task, key, once_timeout, task_id, pending=task.rerun(),
+            once_config=once_config)
+    except AlreadyQueued as e:
+        existing = task._get_existing_result(e, options)
+        if existing is not None:
+            return existing
+        if once_graceful:
+            return EagerResult(None, None, states.REJECTED)
+        raise
+    return task._apply_async_locked(key, task_id, args, kwargs, options)
@@ -1,4 +1,61 @@
 # -*- coding: utf-8 -*-
 
-from .file import File
-from .redis import Redis
+"""
+The locking backends, each imported from its module only when first
+accessed, so that using one does not require (or import) the dependencies
+of the others.
+"""
+
+import importlib
+import sys
+import types
+
+# Module of each backend class.
+_backends = {
+    'File': 'file',
+    'Redis': 'redis',
+    'SharedMemory': 'shared_memory',
+    'SQLite': 'sqlite',
+    'Tiered': 'tiered',
+}
+
+__all__ = sorted(_backends)
+
+
+def __getattr__(name):
+    try:
+        module_name = _backends[name]
+    except KeyError:
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name))
+    module = importlib.import_module('.' + module_name, __name__)
+    backend = getattr(module, name)
+    globals()[name] = backend
+    return backend
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_backends))
+
+
+if sys.version_info < (3, 7):
+    # No module __getattr__ before Python 3.7, give this module a class
+    # defining it instead. File is imported now, as it only needs celery.
+    from .file import File
+
+    class _LazyModule(types.ModuleType):
+        def __getattr__(self, name):
+            return __getattr__(name)
+
+        def __dir__(self):
+            return __dir__()
+
+    try:
+        sys.modules[__name__].__class__ = _LazyModule
+    except TypeError:
+        # Python 2 can't change the class of a module, replace it (keeping
+        # the original, whose globals are cleared once it is collected).
+        _module = _LazyModule(__name__, __doc__)
+        _module.__dict__.update(globals())
+        _module._original = sys.modules[__name__]
+        sys.modules[__name__] = _module
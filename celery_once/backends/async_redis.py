@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""Definition of the asyncio redis locking backend."""
+
+import asyncio
+import uuid
+import weakref
+
+try:
+    import redis.asyncio
+    from redis.exceptions import NoScriptError
+except ImportError:
+    raise ImportError(
+        "You need to install redis>=4.2 in order to use the AsyncRedis"
+        " backend (pip install -U redis)")
+
+from celery_once.backends.redis import (
+    ACQUIRE_LIMIT_SCRIPT, ACQUIRE_PENDING_SCRIPT, ACQUIRE_SCRIPT, DEFAULT_URL,
+    EXTEND_SCRIPT, POOL_SETTINGS, RELEASE_NOTIFY_SCRIPT, RELEASE_SCRIPT,
+    already_queued, parse_url, pending_key, release_channel)
+
+
+def get_async_redis(settings):
+    """
+    Returns a new asyncio client for the settings' url and connection pool
+    settings.
+    """
+    details = parse_url(settings.get('url', DEFAULT_URL))
+    details.update(
+        (name, settings[name]) for name in POOL_SETTINGS if name in settings)
+    if 'sentinels' in details:
+        from redis.asyncio.sentinel import Sentinel
+        sentinels = details.pop('sentinels')
+        service_name = details.pop('service_name')
+        return Sentinel(sentinels, **details).master_for(service_name)
+    elif 'startup_nodes' in details:
+        from redis.asyncio.cluster import RedisCluster, ClusterNode
+        startup_nodes = [ClusterNode(host, port)
+                         for host, port in details.pop('startup_nodes')]
+        return RedisCluster(startup_nodes=startup_nodes, **details)
+    return redis.asyncio.StrictRedis(**details)
+
+
+async def run_script(script, client, keys, args):
+    """
+    Runs a LuaScript with EVALSHA, falling back to EVAL.
+    """
+    try:
+        return await client.evalsha(script.sha, len(keys), *(keys + args))
+    except NoScriptError:
+        return await client.eval(script.script, len(keys), *(keys + args))
+
+
+async def close_pubsub(pubsub):
+    # aclose since redis 5.0.1, which deprecates close.
+    close = getattr(pubsub, 'aclose', None) or pubsub.close
+    await close()
+
+
+class AsyncRedis(object):
+    """
+    Asyncio redis locking backend, with the same settings and locks as the
+    Redis backend. Used by QueueOnce.aapply_async, set as ONCE's
+    'async_backend'.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.blocking_timeout = settings.get("blocking_timeout", 1)
+        self.blocking = settings.get("blocking", False)
+        self.blocking_poll_interval = settings.get(
+            "blocking_poll_interval", 1)
+        self.hash_tag = settings.get("hash_tag", None)
+        # Connections belong to the event loop they were made in, so one
+        # client (and pool) per loop.
+        self._clients = weakref.WeakKeyDictionary()
+
+    @property
+    def redis(self):
+        loop = asyncio.get_event_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = get_async_redis(self.settings)
+        return client
+
+    def _key(self, key):
+        if self.hash_tag is None:
+            return key
+        return '{' + self.hash_tag + '}' + key
+
+    async def raise_or_lock(self, key, timeout, token=None):
+        """
+        Checks if the task is locked and raises an exception, else locks
+        the task. If blocking, waits for the lock's release or expiry as
+        Redis.raise_or_lock does. See Redis.raise_or_lock.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        key = self._key(key)
+        loop = asyncio.get_event_loop()
+        stop_at = None
+        if self.blocking and self.blocking_timeout is not None:
+            stop_at = loop.time() + self.blocking_timeout
+        pubsub = None
+        try:
+            while True:
+                held = await run_script(
+                    ACQUIRE_SCRIPT, self.redis, [key],
+                    [token, int(timeout * 1000)])
+                if held is None:
+                    return
+                now = loop.time()
+                if not self.blocking or (stop_at is not None and now > stop_at):
+                    raise already_queued(held)
+                if pubsub is None:
+                    # Subscribed before trying again, so that a release in
+                    # between is not missed.
+                    pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                    await pubsub.subscribe(release_channel(key))
+                    continue
+                wait = min(held[0] / 1000., self.blocking_poll_interval)
+                if stop_at is not None:
+                    wait = min(wait, stop_at - now)
+                await pubsub.get_message(timeout=max(wait, 0))
+        finally:
+            if pubsub is not None:
+                await close_pubsub(pubsub)
+
+    async def raise_or_lock_pending(self, key, timeout, token=None):
+        """
+        Same as raise_or_lock (without blocking), but marks the lock pending
+        if it is held. See Redis.raise_or_lock_pending.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        key = self._key(key)
+        held = await run_script(
+            ACQUIRE_PENDING_SCRIPT, self.redis, [key, pending_key(key)],
+            [token, int(timeout * 1000)])
+        if held is not None:
+            raise already_queued(held)
+
+    async def raise_or_lock_limit(self, key, window, limit, token=None):
+        """
+        Same as raise_or_lock (without blocking), but the lock can be
+        acquired `limit` times every `window` seconds. See
+        Redis.raise_or_lock_limit.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        interval = int(window * 1000. / limit)
+        held = await run_script(
+            ACQUIRE_LIMIT_SCRIPT, self.redis, [self._key(key)],
+            [token, interval, int(window * 1000) - interval])
+        if held is not None:
+            raise already_queued(held)
+
+    async def extend_lock(self, key, timeout, token):
+        """
+        Sets the lock to expire in timeout seconds, if it still holds the
+        token. Returns whether it did.
+        """
+        return await run_script(EXTEND_SCRIPT, self.redis, [self._key(key)],
+                                [token, int(timeout * 1000)]) == 1
+
+    async def clear_lock(self, key, token=None):
+        """
+        Remove the lock from redis. If a token is given, only if the lock
+        still holds it. If blocking, the release is published to the
+        producers waiting for it.
+        """
+        if self.blocking:
+            key = self._key(key)
+            return await run_script(
+                RELEASE_NOTIFY_SCRIPT, self.redis, [key],
+                [token or '', release_channel(key)])
+        if token is None:
+            return await self.redis.delete(self._key(key))
+        return await run_script(
+            RELEASE_SCRIPT, self.redis, [self._key(key)], [token])
@@ -5,12 +5,31 @@ import hashlib
 import errno
 import os
 import tempfile
+import threading
 import time
+import uuid
+from contextlib import contextmanager
 
 import six
 
+from celery_once.helpers import get_backend
 from celery_once.tasks import AlreadyQueued
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    scandir = None
+
+SWEEP_TASK_NAME = 'celery_once.sweep_file_locks'
+
+# Suffix of the file marking a lock pending, next to the lock file.
+PENDING_SUFFIX = '.pending'
+
 
 def key_to_lock_name(key):
     """
@@ -22,6 +41,62 @@ def key_to_lock_name(key):
     return lock_name
 
 
+def lock_name_to_shards(lock_name, depth):
+    """
+    Directories a lock file goes in, `depth` levels deep, named after
+    2 characters each of the hash ending its name: ['ab', 'cd'] for depth 2.
+    """
+    key_hash = lock_name[-32:]
+    return [key_hash[i * 2:i * 2 + 2] for i in range(depth)]
+
+
+def list_dir(directory):
+    """
+    Yields the (name, is directory) of the directory's entries.
+    """
+    if scandir is None:
+        for name in os.listdir(directory):
+            yield name, os.path.isdir(os.path.join(directory, name))
+        return
+    for entry in scandir(directory):
+        yield entry.name, entry.is_dir()
+
+
+def lock_data(token, expires_at):
+    """
+    Contents of a lock file: its expiry time, then its token.
+    """
+    return six.b('%r %s' % (expires_at, token))
+
+
+def parse_lock_data(data):
+    """
+    Returns the (expiry time, token) of a lock file's contents.
+    The expiry time is None for lock files of previous versions, which only
+    hold a token (or nothing).
+    """
+    expires_at, _, token = data.partition(b' ')
+    try:
+        return float(expires_at), token
+    except ValueError:
+        return None, data
+
+
+def setup_sweeper(app, interval=5 * 60, limit=1000):
+    """
+    Registers a periodic task removing the expired lock files of the app's
+    File backend, `limit` files at most every `interval` seconds.
+    It is sent by celery beat (e.g. ``celery worker --beat``), and must
+    run on the host holding the lock directory.
+    """
+    @app.task(name=SWEEP_TASK_NAME, ignore_result=True)
+    def sweep_file_locks(limit=limit):
+        return get_backend(app, app.conf.ONCE).sweep(limit)
+
+    app.add_periodic_task(interval, sweep_file_locks.s(), name=SWEEP_TASK_NAME)
+    return sweep_file_locks
+
+
 class File(object):
     """
     File locking backend.
@@ -31,6 +106,15 @@ class File(object):
         if self.location is None:
             self.location = os.path.join(tempfile.gettempdir(),
                                          'celery_once')
+        # Lock files of previous versions expire this long after their mtime.
+        self.default_timeout = settings.get('default_timeout', 60 * 60)
+        # Levels of directories lock files are spread in, 0 keeps them all
+        # in location.
+        self.shard_depth = settings.get('shard_depth', 0)
+        # Shard directories known to exist.
+        self._shard_dirs = set()
+        self._sweep_paths = None
+        self._sweep_lock = threading.Lock()
         try:
             os.makedirs(self.location)
         except OSError as error:
@@ -41,36 +125,332 @@ class File(object):
 
     def _get_lock_path(self, key):
         lock_name = key_to_lock_name(key)
+        if self.shard_depth:
+            return os.path.join(
+                self.location,
+                *lock_name_to_shards(lock_name, self.shard_depth) +
+                [lock_name])
         return os.path.join(self.location, lock_name)
 
-    def raise_or_lock(self, key, timeout):
+    def _make_lock_dir(self, lock_path):
         """
-        Check the lock file and create one if it does not exist.
+        Creates the shard directory of a lock file, on its first use.
         """
-        lock_path = self._get_lock_path(key)
+        lock_dir = os.path.dirname(lock_path)
+        if lock_dir in self._shard_dirs:
+            return
         try:
-            # Create lock file, raise exception if it exists
-            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL)
+            os.makedirs(lock_dir)
         except OSError as error:
-            if error.errno == errno.EEXIST:
-                # File already exists, check its modification time
-                mtime = os.path.getmtime(lock_path)
-                ttl = mtime + timeout - time.time()
-                if ttl > 0:
-                    raise AlreadyQueued(ttl)
-                else:
-                    # Update modification time if timeout happens
-                    os.utime(lock_path, None)
-                    return
+            if error.errno != errno.EEXIST:
+                raise
+        self._shard_dirs.add(lock_dir)
+
+    def raise_or_lock(self, key, timeout, token=None):
+        """
+        Check the lock file and create one if it does not exist, or take it
+        over if it expired.
+        The lock file holds its expiry time and the token, which is needed to
+        clear it.
+        """
+        self._raise_or_lock(key, token, timeout)
+
+    def raise_or_lock_pending(self, key, timeout, token=None):
+        """
+        Same as raise_or_lock, but marks the lock pending (with a file next to
+        it) before raising AlreadyQueued. See clear_lock_pending.
+        """
+        self._raise_or_lock(key, token, timeout, pending=True)
+
+    def raise_or_lock_limit(self, key, window, limit, token=None):
+        """
+        Same as raise_or_lock, but the lock can be acquired `limit` times
+        every `window` seconds. Each time pushes its expiry back by
+        window / limit seconds, and it is held while it expires later than
+        window - window / limit seconds from now.
+        """
+        interval = float(window) / limit
+        self._raise_or_lock(key, token, interval, tolerance=window - interval)
+
+    def _raise_or_lock(self, key, token, interval, tolerance=0,
+                       pending=False):
+        """
+        Creates the lock file, to expire in `interval` seconds, or takes it
+        over (see _take_over).
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        lock_path = self._get_lock_path(key)
+        if self.shard_depth:
+            self._make_lock_dir(lock_path)
+        while True:
+            try:
+                # Create lock file, raise exception if it exists
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    # Re-raise unexpected OSError
+                    raise
             else:
-                # Re-raise unexpected OSError
+                try:
+                    os.write(fd, lock_data(token, time.time() + interval))
+                finally:
+                    os.close(fd)
+                return
+            if self._take_over(lock_path, token, interval, tolerance, pending):
+                return
+            # Removed while checking it, try again.
+
+    def _take_over(self, lock_path, token, interval, tolerance=0,
+                   pending=False):
+        """
+        Replaces the lock file, to expire `interval` seconds after it did (or
+        from now if it expired), if it expires within `tolerance` seconds.
+        Raises AlreadyQueued if not (marking the lock pending first if
+        `pending`).
+        Returns False if the lock file was removed meanwhile.
+        """
+        try:
+            with self._open_lock(lock_path) as lock:
+                expires_at = lock[0]
+                if expires_at is None:
+                    # Lock file of a previous version, or still being
+                    # written.
+                    expires_at = os.path.getmtime(lock_path) + interval
+                now = time.time()
+                if expires_at - now > tolerance:
+                    if pending:
+                        os.close(os.open(lock_path + PENDING_SUFFIX,
+                                         os.O_CREAT | os.O_WRONLY))
+                    raise AlreadyQueued(
+                        expires_at - now - tolerance,
+                        task_id=lock[1].decode('latin-1') or None)
+                if pending:
+                    # Marked for the expired owner, who will not rerun.
+                    self._remove_pending(lock_path)
+                self._replace_lock(
+                    lock_path,
+                    lock_data(token, max(expires_at, now) + interval))
+        except OSError as error:
+            if error.errno != errno.ENOENT:
                 raise
-        else:
+            return False
+        return True
+
+    @contextmanager
+    def _open_lock(self, lock_path):
+        """
+        Holds an exclusive flock on the lock file, and gives its
+        (expiry time, token). If the lock file was replaced before the flock
+        was acquired, opens the new one instead, and raises OSError (ENOENT)
+        if it was removed.
+        Lock files are only replaced or removed while holding it (except by
+        clear_lock without a token), so checking a lock file and acting on
+        it can not race with another process.
+        """
+        while True:
+            fd = os.open(lock_path, os.O_RDONLY)
+            if fcntl is None:
+                break
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if self._is_same_file(fd, lock_path):
+                break
+            # Replaced (or removed) meanwhile, also releases the flock.
+            os.close(fd)
+        try:
+            chunks = []
+            chunk = os.read(fd, 1024)
+            while chunk:
+                chunks.append(chunk)
+                chunk = os.read(fd, 1024)
+            yield parse_lock_data(b''.join(chunks))
+        finally:
+            # Also releases the flock.
             os.close(fd)
 
-    def clear_lock(self, key):
+    def _is_same_file(self, fd, lock_path):
+        try:
+            return os.fstat(fd).st_ino == os.stat(lock_path).st_ino
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False
+
+    def _replace_lock(self, lock_path, data):
+        """
+        Writes the lock file aside and renames it over, readers never see a
+        partial file.
+        """
+        tmp_path = '%s.%s.tmp' % (lock_path, uuid.uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, lock_path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def extend_lock(self, key, timeout, token):
+        """
+        Sets the lock file to expire in `timeout` seconds, if it still holds
+        the token. Returns whether it did.
+        """
+        lock_path = self._get_lock_path(key)
+        try:
+            with self._open_lock(lock_path) as lock:
+                if lock[1] != six.b(token):
+                    return False
+                self._replace_lock(
+                    lock_path, lock_data(token, time.time() + timeout))
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def clear_lock(self, key, token=None):
+        """
+        Remove the lock file. If a token is given, only if the lock still
+        holds it (i.e. it did not expire and get acquired again since).
+        Returns False if there was no such lock to remove.
+        """
+        lock_path = self._get_lock_path(key)
+        try:
+            if token is None:
+                os.remove(lock_path)
+                return True
+            with self._open_lock(lock_path) as lock:
+                if lock[1] != six.b(token):
+                    return False
+                os.remove(lock_path)
+        except OSError as error:
+            if token is None or error.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def clear_lock_pending(self, key, token=None):
         """
-        Remove the lock file.
+        Same as clear_lock, but also unmarks the lock if it was marked
+        pending. Returns whether the lock was removed, and whether it was
+        pending.
         """
         lock_path = self._get_lock_path(key)
-        os.remove(lock_path)
+        try:
+            with self._open_lock(lock_path) as lock:
+                if token is not None and lock[1] != six.b(token):
+                    return False, False
+                pending = self._remove_pending(lock_path)
+                os.remove(lock_path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False, False
+        return True, pending
+
+    def _remove_pending(self, lock_path):
+        """
+        Removes the file marking the lock pending, returns whether there
+        was one.
+        """
+        try:
+            os.remove(lock_path + PENDING_SUFFIX)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def _iter_lock_paths(self, directory=None, depth=None):
+        """
+        Yields the paths of the lock files, in location and in its shard
+        directories.
+        """
+        if directory is None:
+            directory, depth = self.location, self.shard_depth
+        for name, is_dir in list_dir(directory):
+            path = os.path.join(directory, name)
+            if not is_dir:
+                if not name.endswith(('.tmp', PENDING_SUFFIX)):
+                    yield path
+            elif depth:
+                for lock_path in self._iter_lock_paths(path, depth - 1):
+                    yield lock_path
+
+    def _remove_if_expired(self, lock_path, now):
+        try:
+            with self._open_lock(lock_path) as lock:
+                expires_at = lock[0]
+                if expires_at is None:
+                    expires_at = (os.path.getmtime(lock_path) +
+                                  self.default_timeout)
+                if expires_at > now:
+                    return False
+                self._remove_pending(lock_path)
+                os.remove(lock_path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def sweep(self, limit=1000):
+        """
+        Removes expired lock files, looking at `limit` files at most and
+        resuming where the previous call stopped, so that a large lock
+        directory is swept over several calls.
+        Returns the number of lock files removed.
+        """
+        now = time.time()
+        removed = 0
+        with self._sweep_lock:
+            for _ in range(limit):
+                if self._sweep_paths is None:
+                    self._sweep_paths = self._iter_lock_paths()
+                lock_path = next(self._sweep_paths, None)
+                if lock_path is None:
+                    # Went through the whole directory, start over next time.
+                    self._sweep_paths = None
+                    break
+                if self._remove_if_expired(lock_path, now):
+                    removed += 1
+        return removed
+
+    def migrate(self):
+        """
+        Moves the lock files kept directly in location (by a flat layout)
+        to their shard directories. A lock acquired in its shard directory
+        meanwhile is kept over the moved one.
+        Returns the number of lock files moved.
+        """
+        moved = 0
+        if not self.shard_depth:
+            return moved
+        for name, is_dir in list(list_dir(self.location)):
+            if is_dir or name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.location, name)
+            # Files marking locks pending move along with their lock file.
+            lock_name = name
+            if name.endswith(PENDING_SUFFIX):
+                lock_name = name[:-len(PENDING_SUFFIX)]
+            lock_path = os.path.join(
+                self.location,
+                *lock_name_to_shards(lock_name, self.shard_depth) + [name])
+            self._make_lock_dir(lock_path)
+            try:
+                # Unlike a rename, never replaces an existing lock file.
+                os.link(path, lock_path)
+                moved += 1
+            except OSError as error:
+                if error.errno not in (errno.EEXIST, errno.ENOENT):
+                    raise
+            try:
+                os.remove(path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+        return moved
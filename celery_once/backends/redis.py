@@ -4,6 +4,11 @@
 
 from __future__ import absolute_import
 
+import hashlib
+import os
+import time
+import uuid
+from collections import OrderedDict
 
 try:
     from urlparse import urlparse, parse_qsl
@@ -17,11 +22,13 @@ from celery_once.tasks import AlreadyQueued
 def parse_url(url):
     """
     Parse the argument url and return a redis connection.
-    Three patterns of url are supported:
+    Five patterns of url are supported:
 
         * redis://host:port[/db][?options]
         * redis+socket:///path/to/redis.sock[?options]
         * rediss://host:port[/db][?options]
+        * redis+sentinel://host:port[,host:port...]/service_name[/db][?options]
+        * redis+cluster://host:port[,host:port...][?options]
 
     A ValueError is raised if the URL is not recognized.
     """
@@ -44,6 +51,31 @@ def parse_url(url):
     # Unix socket redis connection
     elif parsed.scheme == 'redis+socket':
         details = {'unix_socket_path': parsed.path}
+
+    # Sentinels or cluster nodes, with one or more comma separated hosts
+    elif parsed.scheme in ['redis+sentinel', 'redis+cluster']:
+        details = {}
+        netloc = parsed.netloc
+        if '@' in netloc:
+            auth, netloc = netloc.rsplit('@', 1)
+            password = auth.split(':', 1)[-1]
+            if password:
+                details['password'] = password
+        default_port = 26379 if parsed.scheme == 'redis+sentinel' else 6379
+        nodes = []
+        for node in netloc.split(','):
+            host, _, port = node.partition(':')
+            nodes.append((host, int(port) if port else default_port))
+        path = [part for part in parsed.path.split('/') if part]
+        if parsed.scheme == 'redis+sentinel':
+            if not path:
+                raise ValueError('Missing the sentinel service name')
+            details['sentinels'] = nodes
+            details['service_name'] = path[0]
+            if len(path) > 1 and path[1].isdigit():
+                details['db'] = path[1]
+        else:
+            details['startup_nodes'] = nodes
     else:
         raise ValueError('Unsupported protocol %s' % (parsed.scheme))
 
@@ -57,27 +89,253 @@ def parse_url(url):
     return details
 
 
-redis = None
-
 try:
-    from redis.lock import Lock
+    from redis.exceptions import NoScriptError
 except ImportError:
-    raise ImportError(
-        "You need to install the redis library in order to use Redis"
-        " backend (pip install redis)")
+    # Raised by get_redis instead, when the backend is first used.
+    NoScriptError = None
+
+
+DEFAULT_URL = 'redis://localhost:6379/0'
+
+# Settings passed on to the client's connection pool.
+POOL_SETTINGS = ('max_connections', 'socket_keepalive', 'health_check_interval')
+
+# Pool settings only accepted by newer clients, by the redis version that
+# added them.
+POOL_SETTINGS_VERSIONS = {'health_check_interval': (3, 3)}
+
+# Clients by url and pool settings, for the process with id _clients_pid.
+_clients = {}
+_clients_pid = None
 
 
 def get_redis(settings):
-    global redis
-    if not redis:
+    """
+    Returns the client for the settings' url and connection pool settings,
+    created only once per process.
+    """
+    global _clients_pid
+    pid = os.getpid()
+    if _clients_pid != pid:
+        # Connections can't be shared with the parent process after a fork,
+        # start over with new clients (and so new pools).
+        _clients.clear()
+        _clients_pid = pid
+    url = settings.get('url', DEFAULT_URL)
+    pool_settings = tuple(
+        (name, settings[name]) for name in POOL_SETTINGS if name in settings)
+    client = _clients.get((url, pool_settings))
+    if client is None:
         try:
+            import redis
             from redis import StrictRedis
         except ImportError:
             raise ImportError(
                 "You need to install the redis library in order to use Redis"
                 " backend (pip install redis)")
-        redis = StrictRedis(**parse_url(settings['url']))
-    return redis
+        for name, _ in pool_settings:
+            version = POOL_SETTINGS_VERSIONS.get(name)
+            if version is not None and redis.VERSION < version:
+                raise ImportError(
+                    "You need to install redis>={} in order to use the {}"
+                    " setting (pip install -U redis)".format(
+                        '.'.join(map(str, version)), name))
+        details = parse_url(url)
+        details.update(pool_settings)
+        if 'sentinels' in details:
+            client = _get_sentinel_master(details)
+        elif 'startup_nodes' in details:
+            client = _get_cluster(details)
+        else:
+            client = StrictRedis(**details)
+        _clients[(url, pool_settings)] = client
+    return client
+
+
+def _get_sentinel_master(details):
+    from redis import StrictRedis
+    from redis.sentinel import Sentinel
+    sentinels = details.pop('sentinels')
+    service_name = details.pop('service_name')
+    # The connection settings are used for both the sentinels and the master.
+    sentinel = Sentinel(sentinels, **details)
+    return sentinel.master_for(service_name, redis_class=StrictRedis)
+
+
+def _get_cluster(details):
+    try:
+        from redis.cluster import RedisCluster, ClusterNode
+    except ImportError:
+        raise ImportError(
+            "You need to install redis>=4.1 in order to use Redis Cluster"
+            " (pip install -U redis)")
+    startup_nodes = [
+        ClusterNode(host, port) for host, port in details.pop('startup_nodes')]
+    return RedisCluster(startup_nodes=startup_nodes, **details)
+
+
+class LuaScript(object):
+    """
+    A server-side script, run with EVALSHA and falling back to EVAL (which
+    caches it on the server for the next calls) if redis does not know it.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.sha = hashlib.sha1(script.encode('utf-8')).hexdigest()
+
+    def __call__(self, client, keys, args):
+        try:
+            return client.evalsha(self.sha, len(keys), *(keys + args))
+        except NoScriptError:
+            return client.eval(self.script, len(keys), *(keys + args))
+
+    def pipeline(self, client, calls):
+        """
+        Runs the script once per (keys, args) of calls, in a single round trip
+        (two if the script first needs loading).
+        """
+        pipe = client.pipeline(transaction=False)
+        for keys, args in calls:
+            pipe.evalsha(self.sha, len(keys), *(keys + args))
+        results = pipe.execute(raise_on_error=False)
+        missing = [i for i, result in enumerate(results)
+                   if isinstance(result, NoScriptError)]
+        if missing:
+            client.script_load(self.script)
+            retried = self.pipeline(client, [calls[i] for i in missing])
+            for i, result in zip(missing, retried):
+                results[i] = result
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+
+# Sets the lock if there is none, else returns its time remaining in
+# milliseconds and the token it holds, all in one round trip.
+ACQUIRE_SCRIPT = LuaScript("""
+if redis.call('set', KEYS[1], ARGV[1], 'nx', 'px', ARGV[2]) then
+    return false
+end
+return {redis.call('pttl', KEYS[1]), redis.call('get', KEYS[1])}
+""")
+
+# Same as ACQUIRE_SCRIPT for many keys, ARGV holds the timeout then a token
+# per key. Returns a list of (time remaining, token), with nil for each lock
+# acquired.
+ACQUIRE_MANY_SCRIPT = LuaScript("""
+local results = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('set', key, ARGV[i + 1], 'nx', 'px', ARGV[1]) then
+        results[i] = false
+    else
+        results[i] = {redis.call('pttl', key), redis.call('get', key)}
+    end
+end
+return results
+""")
+
+# Same as ACQUIRE_SCRIPT, but marks the lock pending (with the key KEYS[2],
+# expiring after the timeout) if it is held. A pending mark left by a
+# previous owner is removed when acquiring.
+ACQUIRE_PENDING_SCRIPT = LuaScript("""
+if redis.call('set', KEYS[1], ARGV[1], 'nx', 'px', ARGV[2]) then
+    redis.call('del', KEYS[2])
+    return false
+end
+redis.call('set', KEYS[2], 1, 'px', ARGV[2])
+return {redis.call('pttl', KEYS[1]), redis.call('get', KEYS[1])}
+""")
+
+# Same as ACQUIRE_SCRIPT, but the lock can be acquired again while its time
+# remaining is within a tolerance (ARGV[3], window - interval), each time
+# adding the interval (ARGV[2], window / limit) to it: a generic cell rate
+# algorithm, with the lock's expiry as the theoretical arrival time.
+# Returns the time until it can be acquired again and the token it holds.
+ACQUIRE_LIMIT_SCRIPT = LuaScript("""
+local ttl = redis.call('pttl', KEYS[1])
+if ttl < 0 then
+    ttl = 0
+end
+local tolerance = tonumber(ARGV[3])
+if ttl > tolerance then
+    return {ttl - tolerance, redis.call('get', KEYS[1])}
+end
+redis.call('set', KEYS[1], ARGV[1], 'px', ttl + tonumber(ARGV[2]))
+return false
+""")
+
+# Sets the lock's time remaining, only if it still holds the token.
+EXTEND_SCRIPT = LuaScript("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+# Deletes the lock only if it still holds the token it was acquired with.
+RELEASE_SCRIPT = LuaScript("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+# Deletes the lock, only if it still holds the token (if one is given), and
+# tells the producers waiting for it (see Redis.raise_or_lock).
+RELEASE_NOTIFY_SCRIPT = LuaScript("""
+if ARGV[1] == '' or redis.call('get', KEYS[1]) == ARGV[1] then
+    local deleted = redis.call('del', KEYS[1])
+    if deleted == 1 then
+        redis.call('publish', ARGV[2], '')
+    end
+    return deleted
+end
+return 0
+""")
+
+
+# Deletes the lock, only if it still holds the token (if one is given), and
+# its pending mark. Returns whether the lock was deleted and whether it was
+# marked pending. The release is published if a channel is given.
+RELEASE_PENDING_SCRIPT = LuaScript("""
+if ARGV[1] == '' or redis.call('get', KEYS[1]) == ARGV[1] then
+    local deleted = redis.call('del', KEYS[1])
+    if deleted == 1 and ARGV[2] ~= '' then
+        redis.call('publish', ARGV[2], '')
+    end
+    return {deleted, redis.call('del', KEYS[2])}
+end
+return {0, 0}
+""")
+
+
+def pending_key(key):
+    """
+    Redis key marking a lock pending, in the same cluster slot as the lock
+    if it has a hash tag.
+    """
+    return key + ':pending'
+
+
+def already_queued(held):
+    """
+    Returns the AlreadyQueued exception for the (time remaining, token)
+    returned by the acquire scripts.
+    """
+    ttl, token = held
+    if isinstance(token, bytes):
+        token = token.decode('utf-8')
+    return AlreadyQueued(ttl / 1000., task_id=token)
+
+
+def release_channel(key):
+    """
+    Pub/sub channel the release of the lock of a key is published on.
+    """
+    return 'celery_once:released:' + key
 
 
 class Redis(object):
@@ -87,32 +345,168 @@ class Redis(object):
         self._redis = get_redis(settings)
         self.blocking_timeout = settings.get("blocking_timeout", 1)
         self.blocking = settings.get("blocking", False)
+        # Longest wait for a release notification before trying again,
+        # should one be missed.
+        self.blocking_poll_interval = settings.get(
+            "blocking_poll_interval", 1)
+        self.batch_size = settings.get("batch_size", 1000)
+        self.cluster = urlparse(
+            settings.get('url', DEFAULT_URL)).scheme == 'redis+cluster'
+        self.hash_tag = settings.get("hash_tag", None)
 
     @property
     def redis(self):
         # Used to allow easy mocking when testing.
         return self._redis
 
-    def raise_or_lock(self, key, timeout):
+    def _key(self, key):
+        """
+        Returns the redis key of a lock, which starts with the hash tag if
+        one is set, to keep all the locks in a single cluster slot.
+        """
+        if self.hash_tag is None:
+            return key
+        return '{' + self.hash_tag + '}' + key
+
+    def raise_or_lock(self, key, timeout, token=None):
         """
         Checks if the task is locked and raises an exception, else locks
         the task. By default, the tasks and the key expire after 60 minutes.
         (meaning it will not be executed and the lock will clear).
+        The lock holds the token, which is needed to clear it.
+
+        If blocking, waits until the lock is released (as published by
+        clear_lock) or expires, for blocking_timeout seconds at most.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        key = self._key(key)
+        stop_at = None
+        if self.blocking and self.blocking_timeout is not None:
+            stop_at = time.time() + self.blocking_timeout
+        pubsub = None
+        try:
+            while True:
+                # Time remaining in milliseconds and token if already
+                # locked, else None. https://redis.io/commands/pttl
+                held = ACQUIRE_SCRIPT(
+                    self.redis, [key], [token, int(timeout * 1000)])
+                if held is None:
+                    return
+                ttl = held[0]
+                now = time.time()
+                if not self.blocking or (stop_at is not None and now > stop_at):
+                    raise already_queued(held)
+                if pubsub is None:
+                    # Subscribed before trying again, so that a release in
+                    # between is not missed.
+                    pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(release_channel(key))
+                    continue
+                wait = min(ttl / 1000., self.blocking_poll_interval)
+                if stop_at is not None:
+                    wait = min(wait, stop_at - now)
+                pubsub.get_message(timeout=max(wait, 0))
+        finally:
+            if pubsub is not None:
+                pubsub.close()
+
+    def raise_or_lock_pending(self, key, timeout, token=None):
+        """
+        Same as raise_or_lock (without blocking), but marks the lock pending
+        if it is held, in the same script. See clear_lock_pending.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        key = self._key(key)
+        held = ACQUIRE_PENDING_SCRIPT(
+            self.redis, [key, pending_key(key)], [token, int(timeout * 1000)])
+        if held is not None:
+            raise already_queued(held)
+
+    def raise_or_lock_limit(self, key, window, limit, token=None):
+        """
+        Same as raise_or_lock (without blocking), but the lock can be
+        acquired `limit` times every `window` seconds, in one script call.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        interval = int(window * 1000. / limit)
+        held = ACQUIRE_LIMIT_SCRIPT(
+            self.redis, [self._key(key)],
+            [token, interval, int(window * 1000) - interval])
+        if held is not None:
+            raise already_queued(held)
+
+    def lock_many(self, keys, timeout, tokens=None):
+        """
+        Locks each of the keys that is not already locked, in one round trip.
+        Returns a list with, for each key, None if it was locked or the
+        AlreadyQueued exception raise_or_lock would have raised.
+        """
+        if tokens is None:
+            tokens = [uuid.uuid4().hex for _ in keys]
+        keys = [self._key(key) for key in keys]
+        timeout = int(timeout * 1000)
+        # A script can only use keys of one cluster slot, so on a cluster
+        # keys are batched by slot (a single batch with a hash tag).
+        if self.cluster:
+            slots = OrderedDict()
+            for i, key in enumerate(keys):
+                slots.setdefault(self.redis.keyslot(key), []).append(i)
+            groups = list(slots.values())
+        else:
+            groups = [list(range(len(keys)))]
+        calls = []
+        indexes = []
+        for group in groups:
+            for i in range(0, len(group), self.batch_size):
+                chunk = group[i:i + self.batch_size]
+                calls.append(([keys[j] for j in chunk],
+                              [timeout] + [tokens[j] for j in chunk]))
+                indexes.extend(chunk)
+        if self.cluster:
+            # Cluster pipelines don't run scripts, one call per batch.
+            batches = [ACQUIRE_MANY_SCRIPT(self.redis, *call) for call in calls]
+        else:
+            batches = ACQUIRE_MANY_SCRIPT.pipeline(self.redis, calls)
+        results = [None] * len(keys)
+        held = (lock for batch in batches for lock in batch)
+        for i, lock in zip(indexes, held):
+            if lock is not None:
+                results[i] = already_queued(lock)
+        return results
+
+    def extend_lock(self, key, timeout, token):
+        """
+        Sets the lock to expire in timeout seconds, if it still holds the
+        token. Returns whether it did.
+        """
+        return EXTEND_SCRIPT(
+            self.redis, [self._key(key)], [token, int(timeout * 1000)]) == 1
+
+    def clear_lock(self, key, token=None):
+        """
+        Remove the lock from redis. If a token is given, only if the lock
+        still holds it (i.e. it did not expire and get acquired again since).
+        If blocking, the release is published to the producers waiting for it.
+        """
+        if self.blocking:
+            key = self._key(key)
+            return RELEASE_NOTIFY_SCRIPT(
+                self.redis, [key], [token or '', release_channel(key)])
+        if token is None:
+            return self.redis.delete(self._key(key))
+        return RELEASE_SCRIPT(self.redis, [self._key(key)], [token])
+
+    def clear_lock_pending(self, key, token=None):
+        """
+        Same as clear_lock, but also unmarks the lock if it was marked
+        pending, in the same script. Returns whether the lock was removed,
+        and whether it was pending.
         """
-        acquired = Lock(
-            self.redis,
-            key,
-            timeout=timeout,
-            blocking=self.blocking,
-            blocking_timeout=self.blocking_timeout
-        ).acquire()
-
-        if not acquired:
-            # Time remaining in milliseconds
-            # https://redis.io/commands/pttl
-            ttl = self.redis.pttl(key)
-            raise AlreadyQueued(ttl / 1000.)
-
-    def clear_lock(self, key):
-        """Remove the lock from redis."""
-        return self.redis.delete(key)
+        key = self._key(key)
+        channel = release_channel(key) if self.blocking else ''
+        deleted, pending = RELEASE_PENDING_SCRIPT(
+            self.redis, [key, pending_key(key)], [token or '', channel])
+        return deleted == 1, pending == 1
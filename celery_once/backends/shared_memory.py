@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+"""Definition of the shared memory locking backend."""
+
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import six
+
+try:
+    import fcntl
+except ImportError:
+    raise ImportError(
+        "The SharedMemory backend requires fcntl, only available on Unix")
+
+from celery_once.tasks import AlreadyQueued
+
+# Magic, number of slots and of stripes.
+HEADER = struct.Struct('<8sII')
+MAGIC = b'qo-table'
+# State, key digest, expiry time and token digest.
+SLOT = struct.Struct('<B7x16sd16s')
+STATE = struct.Struct('<B')
+EMPTY, USED, DELETED = 0, 1, 2
+
+# Thread locks of the stripes of each table: (path, pid) -> locks. Record
+# locks are per process, so every instance on a table must share them.
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def digest(value):
+    if isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return hashlib.md5(value).digest()
+
+
+class SharedMemory(object):
+    """
+    Shared memory locking backend, for the processes of a single host.
+
+    Locks are kept in a memory-mapped file, an open addressing hash table of
+    fixed-size slots. The table is split in stripes, each guarded by a
+    thread lock and a fcntl record lock, and a key is only ever probed for
+    within its stripe.
+    """
+    def __init__(self, settings):
+        self.path = settings.get('path')
+        if self.path is None:
+            self.path = os.path.join(tempfile.gettempdir(),
+                                     'celery_once.table')
+        self.slots = settings.get('slots', 64 * 1024)
+        self.stripes = settings.get('stripes', 64)
+        if self.slots % self.stripes:
+            raise ValueError('slots must be a multiple of stripes')
+        self.stripe_size = self.slots // self.stripes
+        self.size = HEADER.size + self.slots * SLOT.size
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        self._init_table()
+        self.table = mmap.mmap(self._fd, self.size)
+        self._pid = None
+        self._thread_locks = None
+
+    def _init_table(self):
+        """
+        Creates the table in the file, or checks the one it holds matches the
+        settings.
+        """
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            header = HEADER.pack(MAGIC, self.slots, self.stripes)
+            if os.fstat(self._fd).st_size == 0:
+                # A new file is filled with zeros, all slots are empty.
+                os.ftruncate(self._fd, self.size)
+                os.write(self._fd, header)
+            elif os.read(self._fd, HEADER.size) != header:
+                raise ValueError(
+                    '%s does not hold a lock table of %d slots in %d '
+                    'stripes' % (self.path, self.slots, self.stripes))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+    @contextmanager
+    def _locked(self, stripe):
+        pid = os.getpid()
+        if self._pid != pid:
+            # Not shared with (nor safely inherited by) forked processes.
+            with _thread_locks_lock:
+                self._thread_locks = _thread_locks.setdefault(
+                    (os.path.realpath(self.path), pid),
+                    [threading.Lock() for _ in range(self.stripes)])
+            self._pid = pid
+        with self._thread_locks[stripe]:
+            # Record locks are per process, stripe i locks byte i + 1.
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe + 1)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe + 1)
+
+    def _locate(self, key):
+        """
+        Returns the key's digest, its stripe and its home position within.
+        """
+        key_digest = digest(key)
+        position = struct.unpack('<Q', key_digest[:8])[0]
+        stripe = position % self.stripes
+        return key_digest, stripe, position // self.stripes % self.stripe_size
+
+    def _offset(self, stripe, position):
+        return HEADER.size + (
+            stripe * self.stripe_size + position % self.stripe_size
+        ) * SLOT.size
+
+    def _lookup(self, key_digest, stripe, home, now):
+        """
+        Returns the offset of the key's slot and its (expiry time, token
+        digest), both None if missing, and the offset of the first slot free
+        for it (None if the stripe is full).
+        """
+        free = None
+        for i in range(self.stripe_size):
+            offset = self._offset(stripe, home + i)
+            state, slot_key, expires_at, token = SLOT.unpack_from(
+                self.table, offset)
+            if state == EMPTY:
+                return None, None, offset if free is None else free
+            if state == USED and slot_key == key_digest:
+                return offset, (expires_at, token), free
+            if free is None and (state == DELETED or expires_at <= now):
+                free = offset
+        return None, None, free
+
+    def _delete(self, stripe, offset):
+        """
+        Marks the slot deleted, or empty (with the deleted slots before it)
+        if it ends its probe sequence.
+        """
+        position = (offset - self._offset(stripe, 0)) // SLOT.size
+        following = self._offset(stripe, position + 1)
+        if STATE.unpack_from(self.table, following)[0] != EMPTY:
+            STATE.pack_into(self.table, offset, DELETED)
+            return
+        for i in range(self.stripe_size):
+            offset = self._offset(stripe, position - i)
+            if i and STATE.unpack_from(self.table, offset)[0] != DELETED:
+                break
+            STATE.pack_into(self.table, offset, EMPTY)
+
+    def raise_or_lock(self, key, timeout, token=None):
+        """
+        Checks if the task is locked and raises an exception, else locks
+        the task.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        key_digest, stripe, home = self._locate(key)
+        with self._locked(stripe):
+            now = time.time()
+            offset, lock, free = self._lookup(key_digest, stripe, home, now)
+            if lock is not None:
+                if lock[0] > now:
+                    raise AlreadyQueued(lock[0] - now)
+                # Take over the expired lock.
+                free = offset
+            if free is None:
+                raise RuntimeError(
+                    'The lock table %s is full, it needs more slots'
+                    % self.path)
+            SLOT.pack_into(self.table, free, USED, key_digest, now + timeout,
+                           digest(token))
+
+    def extend_lock(self, key, timeout, token):
+        """
+        Sets the lock to expire in timeout seconds, if it still holds the
+        token. Returns whether it did.
+        """
+        key_digest, stripe, home = self._locate(key)
+        with self._locked(stripe):
+            now = time.time()
+            offset, lock, _ = self._lookup(key_digest, stripe, home, now)
+            if lock is None or lock[1] != digest(token):
+                return False
+            SLOT.pack_into(self.table, offset, USED, key_digest,
+                           now + timeout, lock[1])
+        return True
+
+    def clear_lock(self, key, token=None):
+        """
+        Removes the lock. If a token is given, only if the lock still holds
+        it. Returns False if there was no such lock to remove.
+        """
+        key_digest, stripe, home = self._locate(key)
+        with self._locked(stripe):
+            offset, lock, _ = self._lookup(
+                key_digest, stripe, home, time.time())
+            if lock is None or (
+                    token is not None and lock[1] != digest(token)):
+                return False
+            self._delete(stripe, offset)
+        return True
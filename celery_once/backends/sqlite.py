@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""Definition of the SQLite locking backend."""
+
+from __future__ import absolute_import
+
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from celery_once.tasks import AlreadyQueued
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS {table} (
+    key TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    expires_at REAL NOT NULL
+)
+"""
+
+CREATE_INDEX = """
+CREATE INDEX IF NOT EXISTS {table}_expires_at ON {table} (expires_at)
+"""
+
+# Locks marked pending (see SQLite.raise_or_lock_pending), in a table of
+# their own so that databases of previous versions are kept as is.
+CREATE_PENDING_TABLE = """
+CREATE TABLE IF NOT EXISTS {table}_pending (
+    key TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+)
+"""
+
+# Inserts the lock, or takes over an expired one. A lock still held is left
+# as is, and returned so that its remaining time is known.
+ACQUIRE = """
+INSERT INTO {table} (key, token, expires_at) VALUES (:key, :token, :expires_at)
+ON CONFLICT (key) DO UPDATE SET
+    token = CASE WHEN expires_at <= :now THEN excluded.token ELSE token END,
+    expires_at = CASE WHEN expires_at <= :now
+        THEN excluded.expires_at ELSE expires_at END
+RETURNING token, expires_at
+"""
+
+# For SQLite < 3.35, without RETURNING.
+SELECT = "SELECT token, expires_at FROM {table} WHERE key = :key"
+UPSERT = """
+INSERT OR REPLACE INTO {table} (key, token, expires_at)
+VALUES (:key, :token, :expires_at)
+"""
+
+EXTEND = """
+UPDATE {table} SET expires_at = :expires_at WHERE key = :key AND token = :token
+"""
+
+DELETE = "DELETE FROM {table} WHERE key = :key"
+DELETE_TOKEN = "DELETE FROM {table} WHERE key = :key AND token = :token"
+
+MARK_PENDING = """
+INSERT OR REPLACE INTO {table}_pending (key, expires_at)
+VALUES (:key, :expires_at)
+"""
+UNMARK_PENDING = "DELETE FROM {table}_pending WHERE key = :key"
+
+PURGE = "DELETE FROM {table} WHERE expires_at <= :now"
+PURGE_PENDING = "DELETE FROM {table}_pending WHERE expires_at <= :now"
+PURGE_LIMIT = """
+DELETE FROM {table} WHERE rowid IN (
+    SELECT rowid FROM {table} WHERE expires_at <= :now LIMIT :limit
+)
+"""
+
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35)
+
+
+class SQLite(object):
+    """
+    SQLite locking backend, locks are rows of a single table in a database
+    in WAL mode, shared by the processes of a host (or of a shared volume
+    with working file locks).
+    """
+    def __init__(self, settings):
+        self.path = settings.get('path')
+        if self.path is None:
+            self.path = os.path.join(tempfile.gettempdir(),
+                                     'celery_once.sqlite3')
+        self.table = settings.get('table', 'celery_once_locks')
+        # Seconds to wait for another process' write transaction.
+        self.busy_timeout = settings.get('busy_timeout', 5)
+        # Seconds between purges of the expired locks, None to only purge
+        # when calling purge().
+        self.purge_interval = settings.get('purge_interval', 60)
+        self._next_purge = 0
+        self._local = threading.local()
+        self._queries = dict(
+            (name, query.format(table=self.table)) for name, query in [
+                ('acquire', ACQUIRE), ('select', SELECT), ('upsert', UPSERT),
+                ('extend', EXTEND), ('delete', DELETE),
+                ('delete_token', DELETE_TOKEN), ('purge', PURGE),
+                ('purge_limit', PURGE_LIMIT), ('mark_pending', MARK_PENDING),
+                ('unmark_pending', UNMARK_PENDING),
+                ('purge_pending', PURGE_PENDING)])
+        connection = self.connection
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(CREATE_TABLE.format(table=self.table))
+        connection.execute(CREATE_INDEX.format(table=self.table))
+        connection.execute(CREATE_PENDING_TABLE.format(table=self.table))
+
+    @property
+    def connection(self):
+        """
+        The connection of the current thread (and process).
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            # Autocommit, transactions are started explicitly.
+            self._local.connection = sqlite3.connect(
+                self.path, timeout=self.busy_timeout, isolation_level=None)
+            self._local.pid = pid
+        return self._local.connection
+
+    def _acquire(self, cursor, key, timeout, token, now):
+        """
+        Returns None if the key was locked, or the AlreadyQueued exception
+        to raise.
+        """
+        params = {'key': key, 'token': token, 'now': now,
+                  'expires_at': now + timeout}
+        if HAS_RETURNING:
+            cursor.execute(self._queries['acquire'], params)
+            # Fetching every row ends the statement (and its write lock).
+            held_token, expires_at = cursor.fetchall()[0]
+            if held_token == token and expires_at == params['expires_at']:
+                return None
+        else:
+            cursor.execute(self._queries['select'], params)
+            row = cursor.fetchone()
+            if row is None or row[1] <= now:
+                cursor.execute(self._queries['upsert'], params)
+                return None
+            held_token, expires_at = row
+        return AlreadyQueued(expires_at - now, task_id=held_token)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Runs the statements of a with block in one write transaction,
+        committed if the block succeeds and rolled back if not.
+        """
+        cursor = self.connection.cursor()
+        # Takes the write lock up front, no other writer can come between
+        # reading a lock and writing it.
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+
+    def raise_or_lock(self, key, timeout, token=None):
+        """
+        Checks if the task is locked and raises an exception, else locks
+        the task.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        now = time.time()
+        self._maybe_purge(now)
+        if HAS_RETURNING:
+            error = self._acquire(
+                self.connection.cursor(), key, timeout, token, now)
+        else:
+            with self._transaction() as cursor:
+                error = self._acquire(cursor, key, timeout, token, now)
+        if error is not None:
+            raise error
+
+    def raise_or_lock_pending(self, key, timeout, token=None):
+        """
+        Same as raise_or_lock, but marks the lock pending (until timeout
+        seconds from now) before raising AlreadyQueued, in the same
+        transaction. See clear_lock_pending.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        now = time.time()
+        self._maybe_purge(now)
+        with self._transaction() as cursor:
+            error = self._acquire(cursor, key, timeout, token, now)
+            if error is None:
+                # Marked for a previous owner, whose lock expired.
+                cursor.execute(self._queries['unmark_pending'], {'key': key})
+            else:
+                cursor.execute(self._queries['mark_pending'], {
+                    'key': key, 'expires_at': now + timeout})
+        if error is not None:
+            raise error
+
+    def raise_or_lock_limit(self, key, window, limit, token=None):
+        """
+        Same as raise_or_lock, but the lock can be acquired `limit` times
+        every `window` seconds, in one transaction. Each time pushes its
+        expiry back by window / limit seconds, and it is held while it
+        expires later than window - window / limit seconds from now.
+        """
+        if token is None:
+            token = uuid.uuid4().hex
+        interval = float(window) / limit
+        tolerance = window - interval
+        now = time.time()
+        self._maybe_purge(now)
+        with self._transaction() as cursor:
+            cursor.execute(self._queries['select'], {'key': key})
+            row = cursor.fetchone()
+            expires_at = now if row is None else max(row[1], now)
+            if expires_at - now > tolerance:
+                raise AlreadyQueued(expires_at - now - tolerance,
+                                    task_id=row[0])
+            cursor.execute(self._queries['upsert'], {
+                'key': key, 'token': token,
+                'expires_at': expires_at + interval})
+
+    def lock_many(self, keys, timeout, tokens=None):
+        """
+        Locks each of the keys that is not already locked, in one
+        transaction. Returns a list with, for each key, None if it was
+        locked or the AlreadyQueued exception raise_or_lock would have
+        raised.
+        """
+        if tokens is None:
+            tokens = [uuid.uuid4().hex for _ in keys]
+        now = time.time()
+        self._maybe_purge(now)
+        with self._transaction() as cursor:
+            return [self._acquire(cursor, key, timeout, token, now)
+                    for key, token in zip(keys, tokens)]
+
+    def extend_lock(self, key, timeout, token):
+        """
+        Sets the lock to expire in timeout seconds, if it still holds the
+        token. Returns whether it did.
+        """
+        cursor = self.connection.execute(self._queries['extend'], {
+            'key': key, 'token': token, 'expires_at': time.time() + timeout})
+        return cursor.rowcount == 1
+
+    def clear_lock(self, key, token=None):
+        """
+        Removes the lock. If a token is given, only if the lock still holds
+        it. Returns False if there was no such lock to remove.
+        """
+        if token is None:
+            cursor = self.connection.execute(
+                self._queries['delete'], {'key': key})
+        else:
+            cursor = self.connection.execute(
+                self._queries['delete_token'], {'key': key, 'token': token})
+        return cursor.rowcount == 1
+
+    def clear_lock_pending(self, key, token=None):
+        """
+        Same as clear_lock, but also unmarks the lock if it was marked
+        pending, in the same transaction. Returns whether the lock was
+        removed, and whether it was pending.
+        """
+        with self._transaction() as cursor:
+            if token is None:
+                cursor.execute(self._queries['delete'], {'key': key})
+            else:
+                cursor.execute(self._queries['delete_token'],
+                               {'key': key, 'token': token})
+            if cursor.rowcount != 1:
+                return False, False
+            cursor.execute(self._queries['unmark_pending'], {'key': key})
+            return True, cursor.rowcount == 1
+
+    def clear_many(self, keys, tokens=None):
+        """
+        Removes the locks, like clear_lock, in one transaction. Returns a
+        list with, for each key, whether its lock was removed.
+        """
+        if tokens is None:
+            tokens = [None] * len(keys)
+        results = []
+        with self._transaction() as cursor:
+            for key, token in zip(keys, tokens):
+                if token is None:
+                    cursor.execute(self._queries['delete'], {'key': key})
+                else:
+                    cursor.execute(self._queries['delete_token'],
+                                   {'key': key, 'token': token})
+                results.append(cursor.rowcount == 1)
+        return results
+
+    def _maybe_purge(self, now):
+        if self.purge_interval is not None and now >= self._next_purge:
+            self._next_purge = now + self.purge_interval
+            self.purge()
+
+    def purge(self, limit=None):
+        """
+        Removes expired locks (at most `limit` of them), with a range delete
+        on the expiry index, and expired pending marks. Returns the number of
+        locks removed.
+        """
+        params = {'now': time.time(), 'limit': limit}
+        self.connection.execute(self._queries['purge_pending'], params)
+        if limit is None:
+            cursor = self.connection.execute(self._queries['purge'], params)
+        else:
+            cursor = self.connection.execute(
+                self._queries['purge_limit'], params)
+        return cursor.rowcount
+
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""Definition of the two-tier locking backend."""
+
+from __future__ import absolute_import
+
+from time import time
+
+from celery_once.helpers import ExpiringLRU, import_backend
+from celery_once.tasks import AlreadyQueued
+
+
+class Tiered(object):
+    """
+    Two-tier locking backend. Wraps another backend (the L2, e.g. Redis) with
+    an in-process table (the L1) of the locks this process acquired or found
+    held, until they expire. Keys held in the L1 are rejected without asking
+    the L2.
+
+    A lock cleared by another process is only seen as free once it leaves the
+    L1, after `l1_timeout` seconds at most.
+    """
+    def __init__(self, settings):
+        self.l2 = import_backend(
+            {'backend': settings['l2_backend'], 'settings': settings})
+        # Longest a lock is known held without asking the L2 again.
+        self.l1_timeout = settings.get('l1_timeout', 5)
+        self.l1 = ExpiringLRU(settings.get('l1_size', 10000))
+
+    def _remember(self, key, locked_until, token, now):
+        self.l1.set(key, (locked_until, token),
+                    min(locked_until, now + self.l1_timeout))
+
+    def _check_l1(self, key, now):
+        lock = self.l1.get(key, now)
+        if lock is not None:
+            return AlreadyQueued(lock[0] - now, task_id=lock[1])
+
+    def raise_or_lock(self, key, timeout, token=None):
+        """
+        Raises if the key is held in the L1, else locks it in the L2.
+        """
+        now = time()
+        error = self._check_l1(key, now)
+        if error is not None:
+            raise error
+        try:
+            self.l2.raise_or_lock(key, timeout=timeout, token=token)
+        except AlreadyQueued as e:
+            self._remember(key, now + e.countdown, e.task_id, now)
+            raise
+        self._remember(key, now + timeout, token, now)
+
+    def raise_or_lock_pending(self, key, timeout, token=None):
+        """
+        Same as raise_or_lock, but always asks the L2, to mark the lock
+        pending if it is held.
+        """
+        now = time()
+        try:
+            self.l2.raise_or_lock_pending(key, timeout=timeout, token=token)
+        except AlreadyQueued as e:
+            self._remember(key, now + e.countdown, e.task_id, now)
+            raise
+        self._remember(key, now + timeout, token, now)
+
+    def raise_or_lock_limit(self, key, window, limit, token=None):
+        """
+        Same as raise_or_lock, but the lock can be acquired `limit` times
+        every `window` seconds. The L1 only remembers the lock when it is
+        held, until it can be acquired again.
+        """
+        now = time()
+        error = self._check_l1(key, now)
+        if error is not None:
+            raise error
+        try:
+            self.l2.raise_or_lock_limit(key, window, limit, token=token)
+        except AlreadyQueued as e:
+            self._remember(key, now + e.countdown, e.task_id, now)
+            raise
+
+    def lock_many(self, keys, timeout, tokens=None):
+        """
+        Locks in the L2 the keys not held in the L1, in one batch if the L2
+        supports it.
+        """
+        now = time()
+        results = [self._check_l1(key, now) for key in keys]
+        pending = [i for i, error in enumerate(results) if error is None]
+        if tokens is not None:
+            tokens = [tokens[i] for i in pending]
+        keys_left = [keys[i] for i in pending]
+        errors = []
+        if keys_left and hasattr(self.l2, 'lock_many'):
+            errors = self.l2.lock_many(keys_left, timeout, tokens=tokens)
+        elif keys_left:
+            for i, key in enumerate(keys_left):
+                try:
+                    self.l2.raise_or_lock(
+                        key, timeout=timeout,
+                        token=None if tokens is None else tokens[i])
+                except AlreadyQueued as e:
+                    errors.append(e)
+                else:
+                    errors.append(None)
+        for j, (i, error) in enumerate(zip(pending, errors)):
+            results[i] = error
+            if error is None:
+                self._remember(keys[i], now + timeout,
+                               None if tokens is None else tokens[j], now)
+            else:
+                self._remember(
+                    keys[i], now + error.countdown, error.task_id, now)
+        return results
+
+    def extend_lock(self, key, timeout, token):
+        """
+        Extends the lock in the L2, and in the L1 if it still held it.
+        """
+        extended = self.l2.extend_lock(key, timeout, token)
+        if extended:
+            now = time()
+            self._remember(key, now + timeout, token, now)
+        return extended
+
+    def clear_lock(self, key, token=None):
+        """
+        Removes the lock from both tiers.
+        """
+        self.l1.pop(key)
+        return self.l2.clear_lock(key, token=token)
+
+    def clear_lock_pending(self, key, token=None):
+        """
+        Removes the lock from both tiers, see the L2's clear_lock_pending.
+        """
+        self.l1.pop(key)
+        return self.l2.clear_lock_pending(key, token=token)
@@ -2,18 +2,35 @@
 
 """Definition of helper functions."""
 
+import copy
+import hashlib
 import operator
+import os
 import six
 import importlib
+import logging
+import threading
+import warnings
+import weakref
 from collections import OrderedDict
 from time import time
 
+from celery import Task
 
-def import_backend(config):
+try:
+    from inspect import signature
+except ImportError:
+    from funcsigs import signature
+
+
+logger = logging.getLogger(__name__)
+
+
+def import_backend(config, name='backend'):
     """
-    Imports and initializes the Backend class.
+    Imports and initializes the Backend class (or the one set under `name`).
     """
-    backend_name = config['backend']
+    backend_name = config[name]
     path = backend_name.split('.')
     backend_mod_name, backend_class_name = '.'.join(path[:-1]), path[-1]
     backend_mod = importlib.import_module(backend_mod_name)
@@ -21,6 +38,140 @@ def import_backend(config):
     return backend_class(config['settings'])
 
 
+# Initialized backends of each app: app -> {name: (pid, config, backend)}.
+_backends = weakref.WeakKeyDictionary()
+
+
+def get_backend(app, config, name='backend'):
+    """
+    Returns the app's initialized backend, importing and initializing it only
+    on first use, when the ONCE config changes or after the process forked.
+    """
+    pid = os.getpid()
+    app_backends = _backends.setdefault(app, {})
+    cached = app_backends.get(name)
+    if cached is not None:
+        cached_pid, cached_config, backend = cached
+        if cached_pid == pid and cached_config == config:
+            return backend
+    backend = import_backend(config, name)
+    app_backends[name] = (pid, copy.deepcopy(config), backend)
+    return backend
+
+
+def reset_backends():
+    """
+    Drops every cached backend, they will be initialized again on next use.
+    """
+    _backends.clear()
+
+
+# Whether backend methods (by function) take the token argument.
+_takes_token = {}
+
+
+def takes_token(method):
+    """
+    Returns whether a backend's raise_or_lock or clear_lock takes the
+    `token` argument, which backends written before it was added lack.
+    Warns once per method if it does not.
+    """
+    function = getattr(method, '__func__', method)
+    takes = _takes_token.get(function)
+    if takes is None:
+        try:
+            parameters = signature(method).parameters.values()
+        except (TypeError, ValueError):
+            # Can't tell, e.g. a builtin.
+            parameters = None
+        takes = parameters is None or any(
+            param.name == 'token' or param.kind == param.VAR_KEYWORD
+            for param in parameters)
+        if not takes:
+            warnings.warn(
+                "%s does not take the token argument, so its locks can be "
+                "cleared by other tasks than the one holding them (see "
+                "BACKEND_GUIDE.rst)" % getattr(
+                    function, '__qualname__', function.__name__),
+                DeprecationWarning)
+        _takes_token[function] = takes
+    return takes
+
+
+class Lease(threading.Thread):
+    """
+    Keeps a lock alive while its task runs, by extending it to `timeout`
+    seconds every `timeout / 3` seconds, until stopped or the lock is lost.
+    Errors extending it (e.g. the backend being unreachable) are logged and
+    retried on the next interval.
+    """
+    def __init__(self, backend, key, token, timeout):
+        super(Lease, self).__init__(name='celery_once-lease')
+        self.daemon = True
+        self.backend = backend
+        self.key = key
+        self.token = token
+        self.timeout = timeout
+        self.interval = timeout / 3.
+        self._stopped = threading.Event()
+
+    def extend(self):
+        return self.backend.extend_lock(self.key, self.timeout, self.token)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                extended = self.extend()
+            except Exception:
+                logger.exception("Failed to extend the lock %s", self.key)
+                continue
+            if not extended:
+                # Expired and acquired by another task, nothing to keep.
+                break
+
+    def stop(self):
+        self._stopped.set()
+
+
+class ExpiringLRU(object):
+    """
+    A mapping of at most `max_size` keys, each expiring at a given time,
+    that drops the least recently used key when full. Thread safe.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now=None):
+        """
+        Returns the key's value, or None if it is missing or expired.
+        """
+        now = time() if now is None else now
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or item[0] <= now:
+                return None
+            # Most recently used go last.
+            self._items[key] = item
+            return item[1]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires_at, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+        return None if item is None else item[1]
+
+    def __len__(self):
+        return len(self._items)
+
+
 def items_sorted_by_key(kwargs):
     return sorted(six.iteritems(kwargs), key=operator.itemgetter(0))
 
@@ -74,3 +225,165 @@ def queue_once_key(name, kwargs, restrict_to=None):
         keys += kwargs_to_list(kwargs)
     key = "_".join(keys)
     return key
+
+
+def key_digest(key):
+    """
+    Hex digest (32 characters) of a key.
+    """
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b(key, digest_size=16).hexdigest()
+    # Python < 3.6
+    return hashlib.sha256(key).hexdigest()[:32]
+
+
+def compact_key(key, max_length, prefix):
+    """
+    Returns the key if at most `max_length` long, else `prefix` (the task's
+    KeyBuilder.prefix) followed by the beginning and a digest of the rest
+    of the key, `max_length` long.
+    Raises ValueError if `max_length` leaves no room for the prefix and the
+    digest.
+    """
+    if max_length < len(prefix) + 33:
+        raise ValueError(
+            "max_key_length must be at least {} for keys starting with "
+            "{!r}".format(len(prefix) + 33, prefix))
+    if len(key) <= max_length:
+        return key
+    rest = key[len(prefix):]
+    digest = key_digest(rest)
+    return prefix + rest[:max_length - len(prefix) - 33] + '_' + digest
+
+
+# Types force_string converts, values of any other type are kept as is.
+_FORCED_TYPES = (dict, list, unicode) if six.PY2 else (dict, list)
+
+
+def _value_repr(value):
+    """
+    Equivalent to repr(force_string(value)).
+    """
+    if isinstance(value, dict):
+        return repr(_dict_to_string(value))
+    elif isinstance(value, list):
+        if type(value) is list and not any(
+                issubclass(cls, _FORCED_TYPES) for cls in set(map(type, value))):
+            return repr(value)
+        return '[' + ', '.join([_value_repr(e) for e in value]) + ']'
+    elif six.PY2 and isinstance(value, unicode):
+        return repr(value.encode('utf-8'))
+    return repr(value)
+
+
+def _dict_to_string(d):
+    """
+    Equivalent to force_string(d), for a dict.
+    """
+    items = items_sorted_by_key(d)
+    if six.PY2:
+        # Distinct unicode and str keys can be forced to the same string.
+        items = OrderedDict(
+            (force_string(key), value) for key, value in items).items()
+    return '{' + ', '.join([
+        (_value_repr(key) + ': ' + _value_repr(value)).strip('{}')
+        for key, value in items
+    ]) + '}'
+
+
+def _value_to_string(value):
+    """
+    Equivalent to str(force_string(value)).
+    """
+    if isinstance(value, dict):
+        return _dict_to_string(value)
+    elif isinstance(value, list):
+        return _value_repr(value)
+    elif six.PY2 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class KeyBuilder(object):
+    """
+    Builds the keys of a task, byte-identical to
+    queue_once_key(name, signature.bind(*args, **kwargs).arguments, restrict_to)
+    but with the signature inspected and the arguments ordered only once.
+    Keys longer than `max_length` are compacted (see compact_key).
+    """
+    def __init__(self, name, signature, restrict_to=None, max_length=None):
+        self.name = name
+        self.signature = signature
+        self.restrict_to = restrict_to
+        self.max_length = max_length
+        self.prefix = 'qo_' + force_string(name)
+
+        self.positional = []
+        self.keywords = set()
+        self.required = []
+        self.var_positional = None
+        self.var_keyword = None
+        for param in signature.parameters.values():
+            if param.kind in (param.POSITIONAL_ONLY,
+                              param.POSITIONAL_OR_KEYWORD):
+                self.positional.append(param.name)
+            if param.kind in (param.POSITIONAL_OR_KEYWORD,
+                              param.KEYWORD_ONLY):
+                self.keywords.add(param.name)
+            if param.kind == param.VAR_POSITIONAL:
+                self.var_positional = param.name
+            elif param.kind == param.VAR_KEYWORD:
+                self.var_keyword = param.name
+            elif param.default is param.empty:
+                self.required.append(param.name)
+        self.has_self = 'self' in signature.parameters
+
+        if restrict_to is not None:
+            self.names = sorted(set(restrict_to))
+        else:
+            self.names = sorted(signature.parameters)
+
+    def bind(self, args, kwargs):
+        """
+        Equivalent to signature.bind(*args, **kwargs).arguments, falling back
+        to it for any call it would reject (so the same TypeError is raised).
+        """
+        positional = self.positional
+        if len(args) > len(positional) and self.var_positional is None:
+            return self.signature.bind(*args, **kwargs).arguments
+        call_args = dict(zip(positional, args))
+        if len(args) > len(positional):
+            call_args[self.var_positional] = tuple(args[len(positional):])
+        extra = None
+        for name, value in six.iteritems(kwargs):
+            if name in self.keywords and name not in call_args:
+                call_args[name] = value
+            elif self.var_keyword is not None and name not in call_args:
+                if extra is None:
+                    extra = call_args[self.var_keyword] = {}
+                extra[name] = value
+            else:
+                return self.signature.bind(*args, **kwargs).arguments
+        for name in self.required:
+            if name not in call_args:
+                return self.signature.bind(*args, **kwargs).arguments
+        return call_args
+
+    def __call__(self, args, kwargs):
+        call_args = self.bind(args, kwargs)
+        # See QueueOnce._get_call_args, a bound task instance is left out.
+        if self.has_self and isinstance(call_args.get('self'), Task):
+            del call_args['self']
+        parts = [self.prefix]
+        for name in self.names:
+            if name in call_args:
+                parts.append(
+                    name + '-' + _value_to_string(call_args[name]))
+            elif self.restrict_to is not None:
+                raise KeyError(name)
+        key = '_'.join(parts)
+        if self.max_length is not None:
+            key = compact_key(key, self.max_length, self.prefix)
+        return key
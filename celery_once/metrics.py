@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""Definition of the metrics interface, and a Prometheus implementation."""
+
+from __future__ import absolute_import
+
+
+class Metrics(object):
+    """
+    Receives the lock events of QueueOnce tasks, and the durations of
+    building their keys (``'key'``), and of the backend acquiring
+    (``'acquire'``) and releasing (``'release'``) their locks.
+
+    Set a subclass as ``metrics`` in the ONCE config, it is initialized with
+    its settings like a backend. Does nothing by default; without
+    ``metrics``, tasks do not measure anything.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+
+    def lock_acquired(self, task_name, key):
+        pass
+
+    def lock_rejected(self, task_name, key, countdown):
+        pass
+
+    def lock_cleared(self, task_name, key):
+        pass
+
+    def lock_clear_missed(self, task_name, key):
+        """
+        The lock was not there to clear: it expired (and may have been
+        acquired again), or was cleared already.
+        """
+
+    def observe(self, task_name, stage, seconds):
+        pass
+
+
+# Collectors of each metric name prefix, registered only once per process.
+_collectors = {}
+
+
+class PrometheusMetrics(Metrics):
+    """
+    Exports the lock events and durations as Prometheus metrics, in the
+    default registry of prometheus_client:
+
+    - ``celery_once_locks_total`` counter, by ``task`` and ``result``
+      (``acquired``, ``rejected``, ``cleared`` or ``clear_missed``).
+    - ``celery_once_duration_seconds`` histogram, by ``task`` and ``stage``
+      (``key``, ``acquire`` or ``release``).
+
+    The prefix is set with the ``metrics_prefix`` setting.
+    """
+    def __init__(self, settings):
+        super(PrometheusMetrics, self).__init__(settings)
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImportError(
+                "You need to install the prometheus_client library to use "
+                "the PrometheusMetrics (pip install prometheus_client)")
+        prefix = settings.get('metrics_prefix', 'celery_once')
+        collectors = _collectors.get(prefix)
+        if collectors is None:
+            collectors = _collectors[prefix] = (
+                prometheus_client.Counter(
+                    prefix + '_locks_total', 'Locks of QueueOnce tasks.',
+                    ['task', 'result']),
+                prometheus_client.Histogram(
+                    prefix + '_duration_seconds',
+                    'Durations of building keys, acquiring and releasing '
+                    'locks of QueueOnce tasks.',
+                    ['task', 'stage'],
+                    buckets=(.0001, .00025, .0005, .001, .0025, .005, .01,
+                             .025, .05, .1, .25, .5, 1, float('inf'))),
+            )
+        self.locks, self.durations = collectors
+
+    def lock_acquired(self, task_name, key):
+        self.locks.labels(task_name, 'acquired').inc()
+
+    def lock_rejected(self, task_name, key, countdown):
+        self.locks.labels(task_name, 'rejected').inc()
+
+    def lock_cleared(self, task_name, key):
+        self.locks.labels(task_name, 'cleared').inc()
+
+    def lock_clear_missed(self, task_name, key):
+        self.locks.labels(task_name, 'clear_missed').inc()
+
+    def observe(self, task_name, stage, seconds):
+        self.durations.labels(task_name, stage).observe(seconds)
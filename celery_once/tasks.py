@@ -1,15 +1,32 @@
 # -*- coding: utf-8 -*-
 """Definition of the QueueOnce task and AlreadyQueued exception."""
 
+from collections import OrderedDict
+from time import time
+from timeit import default_timer as timer
+
 from celery import Task, states
 from celery.result import EagerResult
-from .helpers import queue_once_key, import_backend
+from celery.utils import uuid
+from .helpers import (
+    ExpiringLRU, KeyBuilder, Lease, get_backend, takes_token)
+
+
+# Options of the running task's request its rerun is sent with.
+_RERUN_OPTIONS = (
+    'queue', 'exchange', 'routing_key', 'priority', 'expires', 'headers')
 
 
 class AlreadyQueued(Exception):
-    def __init__(self, countdown):
+    """
+    Raised when a task's lock is already held. `task_id` is the token the
+    lock is held with, which is the id of the queued (or running) task for
+    locks of QueueOnce tasks, or None if the backend does not know it.
+    """
+    def __init__(self, countdown, task_id=None):
         self.message = "Expires in {} seconds".format(countdown)
         self.countdown = countdown
+        self.task_id = task_id
 
 try:
     from inspect import signature
@@ -23,6 +40,8 @@ class QueueOnce(Task):
         'graceful': False,
         'unlock_before_run': False
     }
+    _key_builder = None
+    _rejection_cache = None
 
     """
     'There can be only one'. - Highlander (1986)
@@ -51,29 +70,123 @@ class QueueOnce(Task):
     def once_config(self):
         return self.config.ONCE
 
+    # The methods below taking the ONCE config as `once_config` read it
+    # (through app.conf, which is not free) only if it is not given, so that
+    # apply_async reads it once.
+
     @property
     def once_backend(self):
-        return import_backend(self.once_config)
+        return self._get_once_backend()
+
+    def _get_once_backend(self, once_config=None):
+        if once_config is None:
+            once_config = self.once_config
+        backend = get_backend(self._get_app(), once_config)
+        if not self._get_once_setting('l1', True, once_config):
+            # Skips the in-process tier of a Tiered backend.
+            return getattr(backend, 'l2', backend)
+        return backend
+
+    @property
+    def once_async_backend(self):
+        """
+        The backend used by aapply_async, None if ONCE has no async_backend.
+        """
+        return self._get_once_async_backend()
+
+    def _get_once_async_backend(self, once_config=None):
+        if once_config is None:
+            once_config = self.once_config
+        if 'async_backend' not in once_config:
+            return None
+        return get_backend(self._get_app(), once_config, name='async_backend')
+
+    @property
+    def once_metrics(self):
+        """
+        The metrics of the ONCE config (see celery_once.metrics), None if it
+        has none.
+        """
+        return self._get_once_metrics()
+
+    def _get_once_metrics(self, once_config=None):
+        if once_config is None:
+            once_config = self.once_config
+        if 'metrics' not in once_config:
+            return None
+        return get_backend(self._get_app(), once_config, name='metrics')
 
     @property
     def default_timeout(self):
-        return self.once_config['settings'].get('default_timeout', 60 * 60)
+        return self._get_default_timeout()
+
+    def _get_default_timeout(self, once_config=None):
+        if once_config is None:
+            once_config = self.once_config
+        return once_config['settings'].get('default_timeout', 60 * 60)
+
+    def _get_once_setting(self, name, default=None, once_config=None):
+        # Task options take precedence over the ONCE settings.
+        if name in self.once:
+            return self.once[name]
+        if once_config is None:
+            once_config = self.once_config
+        return once_config['settings'].get(name, default)
 
     def unlock_before_run(self):
         return self.once.get('unlock_before_run', False)
 
+    def lease_timeout(self):
+        return self.once.get('lease', None)
+
+    def rerun(self):
+        return self.once.get('rerun', False)
+
+    def window(self):
+        return self.once.get('window', None)
+
+    def window_limit(self):
+        if self.window() is None:
+            return None
+        return self.once.get('limit', None)
+
     def __init__(self, *args, **kwargs):
         self._signature = signature(self.run)
+        # Leases of the running tasks, by token.
+        self._leases = {}
         return super(QueueOnce, self).__init__(*args, **kwargs)
 
     def __call__(self, *args, **kwargs):
         # Only clear the lock before the task's execution if the
         # "unlock_before_run" option is True
         if self.unlock_before_run():
-            key = self.get_key(args, kwargs)
-            self.once_backend.clear_lock(key)
+            # Duplicates rejected until now are covered by this run.
+            self._clear_lock(args, kwargs)
+        elif self.lease_timeout():
+            self._start_lease(args, kwargs)
         return super(QueueOnce, self).__call__(*args, **kwargs)
 
+    def _start_lease(self, args, kwargs):
+        """
+        Shortens the lock to the lease timeout and keeps extending it while
+        the task runs, so it expires soon after if the worker dies.
+        """
+        token = self.get_request_token()
+        if token is None:
+            # Not sent by apply_async, there is no lock to keep.
+            return
+        lease = Lease(self.once_backend, self.get_request_key(args, kwargs),
+                      token, self.lease_timeout())
+        if lease.extend():
+            self._leases[token] = lease
+            lease.start()
+
+    def _stop_lease(self):
+        lease = self._leases.pop(self.get_request_token(), None)
+        if lease is not None:
+            lease.stop()
+            lease.join()
+
     def apply_async(self, args=None, kwargs=None, **options):
         """
         Attempts to queues a task.
@@ -89,22 +202,275 @@ class QueueOnce(Task):
                 An `int' number of seconds after which the lock will expire.
                 If not set, defaults to 1 hour.
             :param: keys: (optional)
+            :param: return_existing: (optional)
+                If True, returns the AsyncResult of the task already queued
+                (or running) instead, when the backend knows its id.
 
+        The key of the lock is sent along in the ``once_key`` header, so the
+        worker does not need to generate it again to clear the lock. The lock
+        holds the task's id as its token, so the worker only clears the lock
+        if it is still the one it was sent with.
         """
         once_options = options.get('once', {})
         once_graceful = once_options.get(
             'graceful', self.once.get('graceful', False))
-        once_timeout = once_options.get(
-            'timeout', self.once.get('timeout', self.default_timeout))
 
         if not options.get('retries'):
-            key = self.get_key(args, kwargs)
+            once_config = self.once_config
+            once_timeout = self._get_once_timeout(options, once_config)
+            metrics = self._get_once_metrics(once_config)
+            self._get_key_builder(once_config)
+            key = self._get_key_measured(args, kwargs, metrics)
+            task_id = options.get('task_id') or uuid()
             try:
-                self.once_backend.raise_or_lock(key, timeout=once_timeout)
+                self._raise_or_lock(
+                    key, once_timeout, task_id, pending=self.rerun(),
+                    once_config=once_config)
             except AlreadyQueued as e:
+                existing = self._get_existing_result(e, options)
+                if existing is not None:
+                    return existing
                 if once_graceful:
                     return EagerResult(None, None, states.REJECTED)
                 raise e
+            return self._apply_async_locked(
+                key, task_id, args, kwargs, options)
+        return super(QueueOnce, self).apply_async(args, kwargs, **options)
+
+    def aapply_async(self, args=None, kwargs=None, **options):
+        """
+        Coroutine version of apply_async, for asyncio applications.
+        The lock is acquired through the ``async_backend`` of the ONCE
+        config without blocking the event loop, or through the backend in
+        the loop's default executor if there is none. The task is then sent
+        as apply_async would.
+        """
+        from .aio import apply_async
+        return apply_async(self, args, kwargs, **options)
+
+    def adelay(self, *args, **kwargs):
+        """
+        Coroutine version of delay, see aapply_async.
+        """
+        return self.aapply_async(args, kwargs)
+
+    def apply_async_many(self, calls, **options):
+        """
+        Attempts to queue a task once per (args, kwargs) of calls, acquiring
+        all the locks in a single batch if the backend supports it (see
+        lock_many in BACKEND_GUIDE.rst). Calls with the same key are only
+        queued once, without asking the backend twice.
+
+        Returns a list with, for each call, either the AsyncResult of the
+        queued task or the AlreadyQueued exception (with its countdown) if it
+        was not queued. AlreadyQueued is never raised. With the
+        ``return_existing`` option, the AsyncResult of the task already
+        queued is given instead of AlreadyQueued, when known.
+
+        :param calls: list of (args, kwargs) tuples.
+        :keyword options: passed on to each apply_async, see apply_async
+            for the supported ``once`` options.
+        """
+        calls = [(args, kwargs) for args, kwargs in calls]
+        if self.window_limit():
+            # Each call takes its share of the limit, even with the key of
+            # another, so they are not batched.
+            options = dict(options, once=dict(
+                options.get('once', {}), graceful=False))
+            results = []
+            for args, kwargs in calls:
+                try:
+                    results.append(
+                        self.apply_async(args, kwargs, **dict(options)))
+                except AlreadyQueued as e:
+                    results.append(e)
+            return results
+        once_config = self.once_config
+        once_timeout = self._get_once_timeout(options, once_config)
+        metrics = self._get_once_metrics(once_config)
+        self._get_key_builder(once_config)
+        keys = [self._get_key_measured(args, kwargs, metrics)
+                for args, kwargs in calls]
+        task_ids = OrderedDict((key, uuid()) for key in keys)
+        unique_keys = list(task_ids)
+        errors = self._lock_many(
+            unique_keys, once_timeout, list(task_ids.values()), once_config)
+
+        results = []
+        queued = set()
+        for (args, kwargs), key in zip(calls, keys):
+            if errors[key] is not None:
+                error = errors[key]
+            elif key in queued:
+                error = AlreadyQueued(once_timeout, task_id=task_ids[key])
+            else:
+                error = None
+            if error is not None:
+                existing = self._get_existing_result(error, options)
+                results.append(error if existing is None else existing)
+            else:
+                queued.add(key)
+                results.append(self._apply_async_locked(
+                    key, task_ids[key], args, kwargs, dict(options)))
+        return results
+
+    def _get_once_timeout(self, options, once_config=None):
+        once_options = options.get('once', {})
+        if 'timeout' in once_options:
+            return once_options['timeout']
+        if 'timeout' in self.once:
+            return self.once['timeout']
+        return self._get_default_timeout(once_config)
+
+    def _get_existing_result(self, error, options):
+        """
+        Returns the AsyncResult of the task holding the lock, if the
+        ``return_existing`` option is set and its id is known.
+        """
+        return_existing = options.get('once', {}).get(
+            'return_existing', self.once.get('return_existing', False))
+        if not return_existing or error.task_id is None:
+            return None
+        return self.AsyncResult(error.task_id)
+
+    def _get_rejection_cache(self, once_config=None):
+        size = self._get_once_setting('rejection_cache_size', 0, once_config)
+        if not size:
+            return None
+        cache = self._rejection_cache
+        if cache is None or cache.max_size != size:
+            cache = self._rejection_cache = ExpiringLRU(size)
+        return cache
+
+    def _cache_rejection(self, cache, key, error, now, once_config=None):
+        """
+        Remembers the key is locked, for a fraction of its countdown, so
+        duplicates are rejected without asking the backend.
+        """
+        if error.countdown > 0:
+            fraction = self._get_once_setting(
+                'rejection_cache_fraction', 0.5, once_config)
+            cache.set(key, (now + error.countdown, error.task_id),
+                      expires_at=now + error.countdown * fraction)
+
+    def _raise_or_lock(self, key, timeout, token, pending=False,
+                       once_config=None):
+        if once_config is None:
+            once_config = self.once_config
+        metrics = self._get_once_metrics(once_config)
+        try:
+            self._raise_or_lock_cached(
+                key, timeout, token, metrics, pending, once_config)
+        except AlreadyQueued as e:
+            if metrics is not None:
+                metrics.lock_rejected(self.name, key, e.countdown)
+            raise
+        if metrics is not None:
+            metrics.lock_acquired(self.name, key)
+
+    def _raise_or_lock_cached(self, key, timeout, token, metrics,
+                              pending=False, once_config=None):
+        # A rejection must reach the backend to mark the lock pending.
+        cache = None if pending else self._get_rejection_cache(once_config)
+        if cache is None:
+            return self._backend_raise_or_lock(
+                key, timeout, token, metrics, pending, once_config)
+        now = time()
+        rejection = cache.get(key, now)
+        if rejection is not None:
+            raise AlreadyQueued(rejection[0] - now, task_id=rejection[1])
+        try:
+            self._backend_raise_or_lock(
+                key, timeout, token, metrics, once_config=once_config)
+        except AlreadyQueued as e:
+            self._cache_rejection(cache, key, e, now, once_config)
+            raise
+
+    def _get_raise_or_lock(self, backend, pending=False):
+        """
+        Returns the backend's method acquiring the task's locks, called with
+        the key, timeout and token.
+        """
+        limit = self.window_limit()
+        if limit:
+            window = self.window()
+            return lambda key, timeout, token: backend.raise_or_lock_limit(
+                key, window, limit, token=token)
+        if pending:
+            return backend.raise_or_lock_pending
+        raise_or_lock = backend.raise_or_lock
+        if not takes_token(raise_or_lock):
+            return lambda key, timeout, token: raise_or_lock(
+                key, timeout=timeout)
+        return raise_or_lock
+
+    def _backend_raise_or_lock(self, key, timeout, token, metrics,
+                               pending=False, once_config=None):
+        raise_or_lock = self._get_raise_or_lock(
+            self._get_once_backend(once_config), pending)
+        if metrics is None:
+            return raise_or_lock(key, timeout=timeout, token=token)
+        started = timer()
+        try:
+            raise_or_lock(key, timeout=timeout, token=token)
+        finally:
+            metrics.observe(self.name, 'acquire', timer() - started)
+
+    def _lock_many(self, keys, timeout, tokens, once_config=None):
+        """
+        Returns a dict with, for each key, None if it was locked or the
+        AlreadyQueued exception raise_or_lock would have raised.
+        """
+        if once_config is None:
+            once_config = self.once_config
+        backend = self._get_once_backend(once_config)
+        pending = self.rerun()
+        cache = None if pending else self._get_rejection_cache(once_config)
+        errors = {}
+        if cache is not None:
+            now = time()
+            for key in keys:
+                rejection = cache.get(key, now)
+                if rejection is not None:
+                    errors[key] = AlreadyQueued(
+                        rejection[0] - now, task_id=rejection[1])
+            tokens = [token for key, token in zip(keys, tokens)
+                      if key not in errors]
+            keys = [key for key in keys if key not in errors]
+
+        metrics = self._get_once_metrics(once_config)
+        if metrics is not None:
+            started = timer()
+        if hasattr(backend, 'lock_many') and not pending:
+            errors.update(zip(keys, backend.lock_many(
+                keys, timeout, tokens=tokens)))
+        else:
+            raise_or_lock = self._get_raise_or_lock(backend, pending)
+            for key, token in zip(keys, tokens):
+                try:
+                    raise_or_lock(key, timeout=timeout, token=token)
+                except AlreadyQueued as e:
+                    errors[key] = e
+                else:
+                    errors[key] = None
+        if metrics is not None:
+            metrics.observe(self.name, 'acquire', timer() - started)
+            for key, error in errors.items():
+                if error is None:
+                    metrics.lock_acquired(self.name, key)
+                else:
+                    metrics.lock_rejected(self.name, key, error.countdown)
+
+        if cache is not None:
+            for key in keys:
+                if errors[key] is not None:
+                    self._cache_rejection(
+                        cache, key, errors[key], now, once_config)
+        return errors
+
+    def _apply_async_locked(self, key, task_id, args, kwargs, options):
+        options['task_id'] = task_id
+        options['headers'] = dict(options.get('headers') or {}, once_key=key)
         return super(QueueOnce, self).apply_async(args, kwargs, **options)
 
     def _get_call_args(self, args, kwargs):
@@ -122,13 +488,139 @@ class QueueOnce(Task):
         Generate the key from the name of the task (e.g. 'tasks.example') and
         args/kwargs.
         """
+        return self._get_key_builder()(args or (), kwargs or {})
+
+    def _get_key_builder(self, once_config=None):
+        """
+        Returns the task's KeyBuilder, built again if the task's name or keys
+        changed. The max_key_length setting is read when it is built, and
+        checked against `once_config` (the ONCE config) when given, as
+        apply_async does before getting keys, so that get_key does not read
+        the config.
+        """
         restrict_to = self.once.get('keys', None)
-        args = args or {}
-        kwargs = kwargs or {}
-        call_args = self._get_call_args(args, kwargs)
-        key = queue_once_key(self.name, call_args, restrict_to)
+        builder = self._key_builder
+        if builder is not None and builder.name == self.name and \
+                builder.restrict_to is restrict_to:
+            if once_config is None or builder.max_length == \
+                    self._get_once_setting('max_key_length', None, once_config):
+                return builder
+        max_length = self._get_once_setting(
+            'max_key_length', None, once_config)
+        builder = self._key_builder = KeyBuilder(
+            self.name, self._signature, restrict_to, max_length)
+        return builder
+
+    def _get_key_measured(self, args, kwargs, metrics):
+        if metrics is None:
+            return self.get_key(args, kwargs)
+        started = timer()
+        key = self.get_key(args, kwargs)
+        metrics.observe(self.name, 'key', timer() - started)
         return key
 
+    def _get_request_header(self, name):
+        request = self.request
+        # Depending on celery's version and the task's protocol, custom
+        # headers are either set on the request or kept in its headers.
+        value = getattr(request, name, None)
+        if value is None:
+            value = (getattr(request, 'headers', None) or {}).get(name)
+        return value
+
+    def get_request_key(self, args=None, kwargs=None):
+        """
+        Returns the key the running task's lock was acquired with, as sent in
+        the ``once_key`` header by apply_async. Only generates the key from
+        args/kwargs if the task was sent without it (e.g. called directly).
+        """
+        key = self._get_request_header('once_key')
+        if key is None:
+            key = self.get_key(args, kwargs)
+        return key
+
+    def get_request_token(self):
+        """
+        Returns the token the running task's lock was acquired with (its task
+        id), or None if the task was not sent by apply_async.
+        """
+        if self._get_request_header('once_key') is None:
+            return None
+        return self.request.id
+
+    def _clear_lock(self, args, kwargs):
+        """
+        Clears the task's lock, or keeps it for the "window" option's seconds
+        from now. Returns whether it was marked pending by rejected
+        duplicates, if the task has the "rerun" option.
+        """
+        if self.window_limit():
+            # Only expires, as acquiring it again is rate limited.
+            return False
+        key = self.get_request_key(args, kwargs)
+        token = self.get_request_token()
+        window = self.window()
+        if window is not None and token is None:
+            # Not sent by apply_async, there is no lock to keep.
+            return False
+        once_config = self.once_config
+        backend = self._get_once_backend(once_config)
+        metrics = self._get_once_metrics(once_config)
+        if metrics is not None:
+            started = timer()
+        if window is not None:
+            cleared, pending = backend.extend_lock(key, window, token), False
+        elif self.rerun():
+            cleared, pending = backend.clear_lock_pending(key, token=token)
+        else:
+            cleared, pending = self._backend_clear_lock(
+                backend, key, token), False
+        if metrics is not None:
+            metrics.observe(self.name, 'release', timer() - started)
+            if cleared:
+                metrics.lock_cleared(self.name, key)
+            else:
+                metrics.lock_clear_missed(self.name, key)
+        return pending
+
+    def _backend_clear_lock(self, backend, key, token):
+        if not takes_token(backend.clear_lock):
+            return backend.clear_lock(key)
+        return backend.clear_lock(key, token=token)
+
+    def _rerun(self, args, kwargs):
+        """
+        Queues the task again, once, after duplicates were rejected while it
+        was queued or running. Not queued if another one was meanwhile.
+        """
+        key = self.get_request_key(args, kwargs)
+        task_id = uuid()
+        once_config = self.once_config
+        try:
+            self._raise_or_lock(
+                key, self._get_once_timeout({}, once_config), task_id,
+                once_config=once_config)
+        except AlreadyQueued:
+            return None
+        return self._apply_async_locked(
+            key, task_id, args, kwargs, self._get_rerun_options())
+
+    def _get_rerun_options(self):
+        """
+        Returns the options the running task was sent with that its rerun
+        keeps, so it is sent where the task was (as retry does).
+        """
+        request_options = self.signature_from_request(self.request).options
+        options = {
+            name: request_options[name] for name in _RERUN_OPTIONS
+            if request_options.get(name) is not None}
+        headers = options.pop('headers', None)
+        if headers:
+            options['headers'] = {
+                name: value for name, value in headers.items()
+                if name != 'once_key'}
+        return options
+
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
         """
         After a task has run (both successfully or with a failure) clear the
@@ -137,5 +629,6 @@ class QueueOnce(Task):
         # Only clear the lock after the task's execution if the
         # "unlock_before_run" option is False
         if not self.unlock_before_run():
-            key = self.get_key(args, kwargs)
-            self.once_backend.clear_lock(key)
+            self._stop_lease()
+            if self._clear_lock(args, kwargs):
+                self._rerun(args, kwargs)
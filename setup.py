@@ -33,7 +33,7 @@ setup(
     author='Cameron Maske',
     author_email='cameronmaske@gmail.com',
     url='https://github.com/cameronmaske/celery-once',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     install_requires=requirements,
     license="BSD",
     keywords='celery, mutex, once, lock, redis',
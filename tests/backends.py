@@ -1,5 +1,7 @@
 import mock
 
+from celery_once import AlreadyQueued
+
 
 class TestBackend(object):
     def __init__(self, settings):
@@ -7,3 +9,46 @@ class TestBackend(object):
 
     raise_or_lock = mock.Mock()
     clear_lock = mock.Mock()
+    extend_lock = mock.Mock()
+    raise_or_lock_pending = mock.Mock()
+    clear_lock_pending = mock.Mock()
+    raise_or_lock_limit = mock.Mock()
+
+
+class LegacyBackend(object):
+    """
+    A backend written before locks held the token of their task.
+    """
+    def __init__(self, settings):
+        self.locks = {}
+
+    def raise_or_lock(self, key, timeout):
+        if key in self.locks:
+            raise AlreadyQueued(timeout)
+        self.locks[key] = timeout
+
+    def clear_lock(self, key):
+        return self.locks.pop(key, None) is not None
+
+
+class TestMetrics(object):
+    def __init__(self, settings):
+        self.settings = settings
+        self.events = []
+        self.stages = []
+
+    def lock_acquired(self, task_name, key):
+        self.events.append(('acquired', task_name, key))
+
+    def lock_rejected(self, task_name, key, countdown):
+        self.events.append(('rejected', task_name, key))
+
+    def lock_cleared(self, task_name, key):
+        self.events.append(('cleared', task_name, key))
+
+    def lock_clear_missed(self, task_name, key):
+        self.events.append(('clear_missed', task_name, key))
+
+    def observe(self, task_name, stage, seconds):
+        assert seconds >= 0
+        self.stages.append((stage, task_name))
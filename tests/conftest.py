@@ -0,0 +1,10 @@
+import sys
+
+
+collect_ignore = []
+if sys.version_info < (3, 7):
+    # Use async/await syntax and asyncio.run.
+    collect_ignore += [
+        'unit/backends/test_async_redis.py',
+        'integration/test_aio.py',
+    ]
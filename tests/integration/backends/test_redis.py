@@ -94,3 +94,28 @@ def test_apply_async_expired(redis):
     example.apply_async(args=(1, ))
 
     assert redis.get("qo_example_a-1") is None
+
+
+def test_apply_async_many(redis):
+    redis.set("qo_example_a-2", 1, px=30000)
+    results = example.apply_async_many([
+        ((1,), {}),
+        ((2,), {}),
+        ((1,), {}),
+    ])
+    assert results[0].state == 'SUCCESS'
+    assert results[1].countdown == pytest.approx(30, rel=0.1)
+    assert isinstance(results[2], AlreadyQueued)
+    assert redis.get("qo_example_a-1") is None
+
+
+@app.task(name="example_taken_over", base=QueueOnce)
+def example_taken_over():
+    # The lock expired and another producer acquired it meanwhile.
+    example_taken_over.once_backend.redis.set(
+        "qo_example_taken_over", "other", px=30000)
+
+
+def test_clear_lock_taken_over(redis):
+    example_taken_over.delay()
+    assert redis.get("qo_example_taken_over") == b"other"
@@ -0,0 +1,117 @@
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+
+from celery import Celery
+from celery_once import QueueOnce, AlreadyQueued
+from celery_once.helpers import reset_backends
+
+
+app = Celery()
+app.conf.ONCE = {
+    'backend': 'tests.backends.TestBackend',
+    'async_backend': 'tests.integration.test_aio.AsyncTestBackend',
+    'settings': {
+        'default_timeout': 60
+    }
+}
+app.conf.CELERY_ALWAYS_EAGER = True
+
+sync_app = Celery()
+sync_app.conf.ONCE = {
+    'backend': 'tests.backends.TestBackend',
+    'settings': {
+        'default_timeout': 60
+    }
+}
+sync_app.conf.CELERY_ALWAYS_EAGER = True
+
+
+class AsyncTestBackend(object):
+    error = None
+
+    def __init__(self, settings):
+        self.calls = []
+
+    def raise_or_lock(self, key, timeout, token=None):
+        self.calls.append((key, timeout, token))
+        future = asyncio.get_event_loop().create_future()
+        if self.error is not None:
+            future.set_exception(self.error)
+        else:
+            future.set_result(None)
+        return future
+
+
+@pytest.fixture(autouse=True)
+def mock_backend(mocker):
+    reset_backends()
+    mocker.patch('tests.backends.TestBackend.raise_or_lock')
+    mocker.patch('tests.backends.TestBackend.clear_lock')
+
+
+@app.task(name="example", base=QueueOnce)
+def example(a=1):
+    return a
+
+
+@sync_app.task(name="sync_example", base=QueueOnce)
+def sync_example(a=1):
+    return a
+
+
+def test_aapply_async():
+    result = asyncio.run(example.aapply_async(args=(2,)))
+    assert result.result == 2
+    assert example.once_async_backend.calls == [
+        ("qo_example_a-2", 60, result.id)]
+    assert example.once_backend.raise_or_lock.called is False
+    example.once_backend.clear_lock.assert_called_with(
+        "qo_example_a-2", token=result.id)
+
+
+def test_adelay():
+    result = asyncio.run(example.adelay(3))
+    assert result.result == 3
+    assert example.once_async_backend.calls[-1][0] == "qo_example_a-3"
+
+
+def test_aapply_async_already_queued():
+    example.once_async_backend.error = AlreadyQueued(30)
+    with pytest.raises(AlreadyQueued):
+        asyncio.run(example.aapply_async())
+    assert example.once_backend.clear_lock.called is False
+
+
+def test_aapply_async_graceful():
+    example.once_async_backend.error = AlreadyQueued(30)
+    result = asyncio.run(example.aapply_async(once={'graceful': True}))
+    assert result.result is None
+
+
+def test_aapply_async_return_existing():
+    example.once_async_backend.error = AlreadyQueued(30, task_id='abc')
+    result = asyncio.run(
+        example.aapply_async(once={'return_existing': True}))
+    assert result.id == 'abc'
+
+
+def test_aapply_async_without_async_backend():
+    result = asyncio.run(sync_example.aapply_async(args=(2,)))
+    assert result.result == 2
+    assert sync_example.once_async_backend is None
+    sync_example.once_backend.raise_or_lock.assert_called_with(
+        "qo_sync_example_a-2", timeout=60, token=result.id)
+
+
+def test_aapply_async_metrics(monkeypatch):
+    monkeypatch.setitem(app.conf.ONCE, 'metrics', 'tests.backends.TestMetrics')
+    asyncio.run(example.aapply_async(args=(2,)))
+    example.once_async_backend.error = AlreadyQueued(30)
+    with pytest.raises(AlreadyQueued):
+        asyncio.run(example.aapply_async(args=(2,)))
+    metrics = example.once_metrics
+    assert [event[0] for event in metrics.events] == [
+        'acquired', 'cleared', 'rejected']
+    assert [stage[0] for stage in metrics.stages] == [
+        'key', 'acquire', 'release', 'key', 'acquire']
@@ -1,7 +1,9 @@
 import pytest
 
 from celery import Celery
+from celery.result import AsyncResult
 from celery_once import QueueOnce, AlreadyQueued
+from celery_once.helpers import reset_backends
 
 
 app = Celery()
@@ -16,8 +18,14 @@ app.conf.CELERY_ALWAYS_EAGER = True
 
 @pytest.fixture(autouse=True)
 def mock_backend(mocker):
+    reset_backends()
     mocker.patch('tests.backends.TestBackend.raise_or_lock')
     mocker.patch('tests.backends.TestBackend.clear_lock')
+    mocker.patch('tests.backends.TestBackend.extend_lock')
+    mocker.patch('tests.backends.TestBackend.raise_or_lock_pending')
+    mocker.patch('tests.backends.TestBackend.clear_lock_pending',
+                 return_value=(True, False))
+    mocker.patch('tests.backends.TestBackend.raise_or_lock_limit')
 
 
 @app.task(name="example", base=QueueOnce)
@@ -50,21 +58,39 @@ def test_once_config():
     }
 
 
+def test_once_backend_cached():
+    assert example.once_backend is example.once_backend
+    assert example.once_backend is example_retry.once_backend
+
+
+def test_once_backend_config_changed(monkeypatch):
+    backend = example.once_backend
+    monkeypatch.setitem(app.conf.ONCE['settings'], 'default_timeout', 120)
+    assert example.once_backend is not backend
+    assert example.once_backend.settings['default_timeout'] == 120
+
+
+def test_once_backend_after_fork(monkeypatch):
+    backend = example.once_backend
+    monkeypatch.setattr('celery_once.helpers.os.getpid', lambda: -1)
+    assert example.once_backend is not backend
+
+
 def test_default_timeout():
     assert example.default_timeout == 60
 
 
 def test_apply_async():
-    example.apply_async()
+    result = example.apply_async()
     example.once_backend.raise_or_lock.assert_called_with(
-        "qo_example", timeout=60)
+        "qo_example", timeout=60, token=result.id)
 
 
 def test_apply_async_timeout(mocker):
     example.once_backend.raise_or_lock = mocker.Mock()
     example.apply_async(once={'timeout': 120})
     example.once_backend.raise_or_lock.assert_called_with(
-        "qo_example", timeout=120)
+        "qo_example", timeout=120, token=mocker.ANY)
 
 
 def test_raise_already_queued():
@@ -79,11 +105,29 @@ def test_raise_already_queued_graceful():
     assert result.result is None
 
 
+def test_return_existing():
+    example.once_backend.raise_or_lock.side_effect = AlreadyQueued(
+        60, task_id='abc')
+    result = example.apply_async(once={'return_existing': True})
+    assert isinstance(result, AsyncResult)
+    assert result.id == 'abc'
+
+
+def test_return_existing_unknown():
+    example.once_backend.raise_or_lock.side_effect = AlreadyQueued(60)
+    with pytest.raises(AlreadyQueued):
+        example.apply_async(once={'return_existing': True})
+    result = example.apply_async(
+        once={'return_existing': True, 'graceful': True})
+    assert result.state == 'REJECTED'
+
+
 def test_retry():
-    example_retry.apply_async()
+    result = example_retry.apply_async()
     example.once_backend.raise_or_lock.assert_called_with(
-        "qo_example_retry", timeout=60)
-    example.once_backend.clear_lock.assert_called_with("qo_example_retry")
+        "qo_example_retry", timeout=60, token=result.id)
+    example.once_backend.clear_lock.assert_called_with(
+        "qo_example_retry", token=result.id)
 
 
 def test_delay_unlock_before_run(mocker):
@@ -94,6 +138,378 @@ def test_delay_unlock_before_run(mocker):
     mock_parent.attach_mock(after_return_mock, 'after_return')
     example_unlock_before_run.once_backend.clear_lock.side_effect = clear_lock_mock
     example_unlock_before_run.after_return = after_return_mock
-    example_unlock_before_run.apply_async()
+    result = example_unlock_before_run.apply_async()
     assert len(mock_parent.mock_calls) == 2
-    assert mock_parent.mock_calls[0] == mocker.call.clear_lock('qo_example_unlock_before_run')
+    assert mock_parent.mock_calls[0] == mocker.call.clear_lock(
+        'qo_example_unlock_before_run', token=result.id)
+
+
+def test_apply_async_key_header(mocker):
+    get_key = mocker.spy(example, 'get_key')
+    result = example.apply_async(headers={'other': 1})
+    assert get_key.call_count == 1
+    example.once_backend.clear_lock.assert_called_with(
+        "qo_example", token=result.id)
+
+
+def test_retry_key_header(mocker):
+    get_key = mocker.spy(example_retry, 'get_key')
+    result = example_retry.apply_async()
+    assert get_key.call_count == 1
+    example.once_backend.clear_lock.assert_called_with(
+        "qo_example_retry", token=result.id)
+
+
+def test_after_return_without_key_header():
+    example.after_return(None, None, None, (), {}, None)
+    example.once_backend.clear_lock.assert_called_with(
+        "qo_example", token=None)
+
+
+@app.task(name="example_args", base=QueueOnce)
+def example_args(a, b=0):
+    return
+
+
+def test_apply_async_many(mocker):
+    def raise_or_lock(key, timeout, token):
+        if key == "qo_example_args_a-2":
+            raise AlreadyQueued(30)
+    example_args.once_backend.raise_or_lock.side_effect = raise_or_lock
+    results = example_args.apply_async_many([
+        ((1,), {}),
+        ((2,), {}),
+        ((), {'a': 1}),
+        ((3,), {'b': 1}),
+    ])
+    assert example_args.once_backend.raise_or_lock.call_count == 3
+    assert results[0].state == 'SUCCESS'
+    assert isinstance(results[1], AlreadyQueued)
+    assert results[1].countdown == 30
+    assert isinstance(results[2], AlreadyQueued)
+    assert results[2].countdown == 60
+    assert results[3].state == 'SUCCESS'
+    example_args.once_backend.raise_or_lock.assert_called_with(
+        "qo_example_args_a-3_b-1", timeout=60, token=results[3].id)
+
+
+def test_apply_async_many_return_existing():
+    def raise_or_lock(key, timeout, token):
+        if key == "qo_example_args_a-2":
+            raise AlreadyQueued(30, task_id='abc')
+    example_args.once_backend.raise_or_lock.side_effect = raise_or_lock
+    results = example_args.apply_async_many(
+        [((1,), {}), ((2,), {}), ((1,), {})], once={'return_existing': True})
+    assert results[1].id == 'abc'
+    # Duplicates in the calls share the result of the task queued.
+    assert results[2].id == results[0].id
+
+
+@app.task(name="example_rerun", base=QueueOnce, once={'rerun': True})
+def example_rerun(a):
+    return a
+
+
+def test_rerun_marks_pending(mocker):
+    backend = example_rerun.once_backend
+    backend.raise_or_lock_pending.side_effect = AlreadyQueued(60)
+    with pytest.raises(AlreadyQueued):
+        example_rerun.apply_async(args=(1,))
+    backend.raise_or_lock_pending.assert_called_with(
+        "qo_example_rerun_a-1", timeout=60, token=mocker.ANY)
+    assert backend.raise_or_lock.called is False
+
+
+def test_rerun_pending():
+    backend = example_rerun.once_backend
+    backend.clear_lock_pending.side_effect = [(True, True), (True, False)]
+    result = example_rerun.apply_async(args=(1,))
+    backend.clear_lock_pending.assert_any_call(
+        "qo_example_rerun_a-1", token=result.id)
+    # Queued again once, without marking the lock pending.
+    assert backend.raise_or_lock.call_count == 1
+    rerun_id = backend.raise_or_lock.call_args[1]['token']
+    assert rerun_id != result.id
+    backend.clear_lock_pending.assert_called_with(
+        "qo_example_rerun_a-1", token=rerun_id)
+    assert backend.clear_lock.called is False
+
+
+def test_rerun_options(mocker):
+    backend = example_rerun.once_backend
+    backend.clear_lock_pending.side_effect = [(True, True), (True, False)]
+    apply_async_locked = mocker.spy(example_rerun, '_apply_async_locked')
+    example_rerun.apply_async(
+        args=(1,), exchange='', routing_key='other', priority=3,
+        headers={'origin': 'test'})
+    options = apply_async_locked.call_args_list[1][0][4]
+    assert options == {
+        'queue': 'other', 'priority': 3,
+        'headers': {'origin': 'test', 'once_key': "qo_example_rerun_a-1"},
+        'task_id': backend.raise_or_lock.call_args[1]['token']}
+
+
+def test_rerun_not_pending():
+    backend = example_rerun.once_backend
+    example_rerun.apply_async(args=(1,))
+    assert backend.clear_lock_pending.call_count == 1
+    assert backend.raise_or_lock.called is False
+
+
+def test_rerun_queued_meanwhile():
+    backend = example_rerun.once_backend
+    backend.clear_lock_pending.return_value = (True, True)
+    backend.raise_or_lock.side_effect = AlreadyQueued(60)
+    example_rerun.apply_async(args=(1,))
+    assert backend.raise_or_lock.call_count == 1
+    assert backend.clear_lock_pending.call_count == 1
+
+
+@app.task(name="example_window", base=QueueOnce, once={'window': 10})
+def example_window():
+    return
+
+
+@app.task(name="example_window_limit", base=QueueOnce,
+          once={'window': 10, 'limit': 3})
+def example_window_limit():
+    return
+
+
+def test_window():
+    backend = example_window.once_backend
+    result = example_window.apply_async()
+    backend.raise_or_lock.assert_called_with(
+        "qo_example_window", timeout=60, token=result.id)
+    backend.extend_lock.assert_called_once_with(
+        "qo_example_window", 10, result.id)
+    assert backend.clear_lock.called is False
+
+
+def test_window_limit():
+    backend = example_window_limit.once_backend
+    result = example_window_limit.apply_async()
+    backend.raise_or_lock_limit.assert_called_once_with(
+        "qo_example_window_limit", 10, 3, token=result.id)
+    assert backend.raise_or_lock.called is False
+    assert backend.extend_lock.called is False
+    assert backend.clear_lock.called is False
+
+
+def test_window_limit_many():
+    backend = example_window_limit.once_backend
+    backend.raise_or_lock_limit.side_effect = [None, None, AlreadyQueued(3)]
+    results = example_window_limit.apply_async_many(
+        [((), {}), ((), {}), ((), {})], once={'graceful': True})
+    # Calls with the same key each take their share of the limit.
+    assert backend.raise_or_lock_limit.call_count == 3
+    assert results[0].state == 'SUCCESS'
+    assert results[1].state == 'SUCCESS'
+    assert isinstance(results[2], AlreadyQueued)
+
+
+@app.task(name="example_lease", base=QueueOnce, once={'lease': 30})
+def example_lease():
+    return example_lease._leases[example_lease.request.id].is_alive()
+
+
+def test_lease():
+    result = example_lease.apply_async()
+    assert result.result is True
+    example_lease.once_backend.extend_lock.assert_called_once_with(
+        "qo_example_lease", 30, result.id)
+    assert example_lease._leases == {}
+    example_lease.once_backend.clear_lock.assert_called_with(
+        "qo_example_lease", token=result.id)
+
+
+def test_lease_lost():
+    example_lease.once_backend.extend_lock.return_value = False
+    result = example_lease.apply_async()
+    assert result.state == 'FAILURE'  # The task found no lease running.
+
+
+def test_lease_called_directly():
+    example_lease.once_backend.extend_lock.return_value = True
+    with pytest.raises(KeyError):
+        example_lease()
+    assert example_lease.once_backend.extend_lock.called is False
+
+
+@app.task(name="example_rejection_cache", base=QueueOnce,
+          once={'rejection_cache_size': 10, 'rejection_cache_fraction': 0.5})
+def example_rejection_cache(a=0):
+    return
+
+
+def test_rejection_cache(mocker):
+    backend = example_rejection_cache.once_backend
+    backend.raise_or_lock.side_effect = AlreadyQueued(60)
+    time_mock = mocker.patch('celery_once.tasks.time', return_value=1000.)
+    with pytest.raises(AlreadyQueued):
+        example_rejection_cache.apply_async()
+    assert backend.raise_or_lock.call_count == 1
+
+    time_mock.return_value = 1020.
+    with pytest.raises(AlreadyQueued) as e:
+        example_rejection_cache.apply_async()
+    assert e.value.countdown == 40
+    assert backend.raise_or_lock.call_count == 1
+
+    # Once half of the countdown passed, the backend is asked again.
+    time_mock.return_value = 1030.
+    with pytest.raises(AlreadyQueued):
+        example_rejection_cache.apply_async()
+    assert backend.raise_or_lock.call_count == 2
+
+
+def test_rejection_cache_many(mocker):
+    backend = example_rejection_cache.once_backend
+    backend.raise_or_lock.side_effect = AlreadyQueued(60)
+    mocker.patch('celery_once.tasks.time', return_value=2000.)
+    with pytest.raises(AlreadyQueued):
+        example_rejection_cache.apply_async(args=(1,))
+    backend.raise_or_lock.side_effect = None
+    results = example_rejection_cache.apply_async_many(
+        [((1,), {}), ((2,), {})])
+    assert results[0].countdown == 60
+    assert results[1].state == 'SUCCESS'
+    backend.raise_or_lock.assert_called_with(
+        "qo_example_rejection_cache_a-2", timeout=60, token=results[1].id)
+    assert backend.raise_or_lock.call_count == 2
+
+
+def test_rejection_cache_disabled():
+    backend = example.once_backend
+    backend.raise_or_lock.side_effect = AlreadyQueued(60)
+    for _ in range(2):
+        with pytest.raises(AlreadyQueued):
+            example.apply_async()
+    assert backend.raise_or_lock.call_count == 2
+
+
+@app.task(name="example_compact", base=QueueOnce,
+          once={'max_key_length': 64})
+def example_compact(ids):
+    return
+
+
+def test_max_key_length():
+    assert example_compact.get_key(kwargs={'ids': [1, 2]}) == \
+        "qo_example_compact_ids-[1, 2]"
+    key = example_compact.get_key(kwargs={'ids': list(range(100))})
+    assert len(key) == 64
+    assert key.startswith("qo_example_compact_ids-[0, 1, 2_")
+    result = example_compact.apply_async(kwargs={'ids': list(range(100))})
+    example_compact.once_backend.clear_lock.assert_called_with(
+        key, token=result.id)
+
+
+def test_max_key_length_setting(monkeypatch):
+    ids = list(range(100))
+    assert example_args.get_key(args=(ids,)) == example_args.get_key(
+        kwargs={'a': ids})
+    monkeypatch.setitem(app.conf.ONCE['settings'], 'max_key_length', 64)
+    # Taken into account by the next apply_async.
+    example_args.apply_async(args=(ids,))
+    key = example_args.once_backend.raise_or_lock.call_args[0][0]
+    assert len(key) == 64
+    assert example_args.get_key(args=(ids,)) == key
+
+
+def test_get_key_does_not_read_config(mocker):
+    example_compact.get_key(kwargs={'ids': [1, 2]})
+    once_config = mocker.patch.object(
+        QueueOnce, 'once_config', new_callable=mocker.PropertyMock)
+    assert example_compact.get_key(kwargs={'ids': [1, 2]}) == \
+        "qo_example_compact_ids-[1, 2]"
+    assert once_config.called is False
+
+
+@pytest.fixture()
+def metrics(monkeypatch):
+    monkeypatch.setitem(app.conf.ONCE, 'metrics', 'tests.backends.TestMetrics')
+    return example.once_metrics
+
+
+def test_legacy_backend(monkeypatch):
+    monkeypatch.setitem(
+        app.conf.ONCE, 'backend', 'tests.backends.LegacyBackend')
+    monkeypatch.setattr('celery_once.helpers._takes_token', {})
+    with pytest.warns(DeprecationWarning):
+        example_args.apply_async(args=(1,))
+    # Locked, then cleared by the task.
+    assert example_args.once_backend.locks == {}
+    example_args.once_backend.locks["qo_example_args_a-2"] = 60
+    with pytest.raises(AlreadyQueued):
+        example_args.apply_async(args=(2,))
+
+
+@pytest.fixture()
+def once_config(mocker):
+    return mocker.patch.object(
+        QueueOnce, 'once_config', new_callable=mocker.PropertyMock,
+        return_value=app.conf.ONCE)
+
+
+@pytest.mark.parametrize('settings', [
+    {}, {'metrics': 'tests.backends.TestMetrics'},
+])
+def test_apply_async_reads_config_once(monkeypatch, once_config, settings):
+    for name, value in settings.items():
+        monkeypatch.setitem(app.conf.ONCE, name, value)
+    monkeypatch.setitem(
+        app.conf.ONCE['settings'], 'rejection_cache_size', 10)
+    example_args.apply_async(args=(1,))
+    # And once more when the (eager) task returns.
+    assert once_config.call_count == 2
+    example_args.once_backend.raise_or_lock.side_effect = AlreadyQueued(60)
+    once_config.reset_mock()
+    with pytest.raises(AlreadyQueued):
+        example_args.apply_async(args=(2,))
+    assert once_config.call_count == 1
+    once_config.reset_mock()
+    example_args.apply_async_many([((3,), {}), ((4,), {})])
+    assert once_config.call_count == 1
+
+
+def test_metrics_disabled():
+    assert example.once_metrics is None
+
+
+def test_metrics(metrics):
+    example.once_backend.clear_lock.return_value = 1
+    example.apply_async()
+    example.once_backend.clear_lock.return_value = 0
+    example.apply_async()
+    example.once_backend.raise_or_lock.side_effect = AlreadyQueued(60)
+    with pytest.raises(AlreadyQueued):
+        example.apply_async()
+    assert metrics.events == [
+        ('acquired', 'example', 'qo_example'),
+        ('cleared', 'example', 'qo_example'),
+        ('acquired', 'example', 'qo_example'),
+        ('clear_missed', 'example', 'qo_example'),
+        ('rejected', 'example', 'qo_example'),
+    ]
+    assert metrics.stages == [
+        ('key', 'example'), ('acquire', 'example'), ('release', 'example'),
+        ('key', 'example'), ('acquire', 'example'), ('release', 'example'),
+        ('key', 'example'), ('acquire', 'example'),
+    ]
+
+
+def test_metrics_many(metrics):
+    def raise_or_lock(key, timeout, token):
+        if key == "qo_example_args_a-2":
+            raise AlreadyQueued(30)
+    example_args.once_backend.raise_or_lock.side_effect = raise_or_lock
+    example_args.apply_async_many([((1,), {}), ((2,), {})])
+    assert metrics.events[:2] == [
+        ('acquired', 'example_args', 'qo_example_args_a-1'),
+        ('rejected', 'example_args', 'qo_example_args_a-2'),
+    ]
+    assert metrics.stages[:3] == [
+        ('key', 'example_args'), ('key', 'example_args'),
+        ('acquire', 'example_args'),
+    ]
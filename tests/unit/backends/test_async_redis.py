@@ -0,0 +1,169 @@
+import asyncio
+
+import pytest
+from pytest import approx
+
+pytest.importorskip('redis.asyncio')
+from fakeredis import FakeAsyncRedis
+
+from celery_once.backends.async_redis import AsyncRedis, get_async_redis
+from celery_once.tasks import AlreadyQueued
+
+
+@pytest.fixture()
+def redis(monkeypatch):
+    fake_redis = FakeAsyncRedis()
+    monkeypatch.setattr(
+        "celery_once.backends.async_redis.AsyncRedis.redis", fake_redis)
+    asyncio.run(fake_redis.flushall())
+    return fake_redis
+
+
+@pytest.fixture()
+def backend():
+    return AsyncRedis({'url': "redis://localhost:1337"})
+
+
+def test_get_async_redis():
+    client = get_async_redis({
+        'url': "redis://localhost:1337/2",
+        'max_connections': 5,
+    })
+    kwargs = client.connection_pool.connection_kwargs
+    assert (kwargs['host'], kwargs['port'], kwargs['db']) == \
+        ("localhost", 1337, 2)
+    assert client.connection_pool.max_connections == 5
+
+
+def test_client_per_loop(backend):
+    async def get_client():
+        return backend.redis
+
+    first = asyncio.run(get_client())
+    assert asyncio.run(get_client()) is not first
+
+
+def test_raise_or_lock(redis, backend):
+    async def run():
+        await backend.raise_or_lock(key="test", timeout=60, token="abc")
+        return await redis.get("test"), await redis.pttl("test")
+
+    value, ttl = asyncio.run(run())
+    assert value == b"abc"
+    assert ttl == approx(60000, rel=0.1)
+
+
+def test_raise_or_lock_locked(redis, backend):
+    async def run():
+        await redis.set("test", "def", px=30000)
+        await backend.raise_or_lock(key="test", timeout=60, token="abc")
+
+    with pytest.raises(AlreadyQueued) as e:
+        asyncio.run(run())
+    assert e.value.countdown == approx(30.0, rel=0.1)
+    assert e.value.task_id == "def"
+
+
+def test_raise_or_lock_blocking(redis, backend):
+    backend.blocking = True
+    backend.blocking_timeout = 0.3
+
+    async def run():
+        await redis.set("test", "def", px=100)
+        await backend.raise_or_lock(key="test", timeout=60, token="abc")
+        return await redis.get("test")
+
+    assert asyncio.run(run()) == b"abc"
+
+
+def test_raise_or_lock_blocking_notified(redis, backend):
+    backend.blocking = True
+    backend.blocking_timeout = 5
+    backend.blocking_poll_interval = 5
+
+    async def run():
+        loop = asyncio.get_event_loop()
+        await backend.raise_or_lock(key="test", timeout=60, token="abc")
+        loop.call_later(0.2, lambda: asyncio.ensure_future(
+            backend.clear_lock("test", token="abc")))
+        start = loop.time()
+        await backend.raise_or_lock(key="test", timeout=60, token="def")
+        return loop.time() - start, await redis.get("test")
+
+    waited, token = asyncio.run(run())
+    # Woken up by the release, not by polling.
+    assert waited < 1
+    assert token == b"def"
+
+
+def test_raise_or_lock_blocking_timeout(redis, backend):
+    backend.blocking = True
+    backend.blocking_timeout = 0.2
+
+    async def run():
+        loop = asyncio.get_event_loop()
+        await redis.set("test", "def", px=30000)
+        start = loop.time()
+        try:
+            await backend.raise_or_lock(key="test", timeout=60)
+        except AlreadyQueued:
+            return loop.time() - start
+
+    assert asyncio.run(run()) == approx(0.2, abs=0.15)
+
+
+def test_raise_or_lock_pending(redis, backend):
+    async def run():
+        await backend.raise_or_lock_pending(
+            key="test", timeout=60, token="abc")
+        pending = await redis.get("test:pending")
+        try:
+            await backend.raise_or_lock_pending(key="test", timeout=60)
+        except AlreadyQueued as e:
+            return pending, e.task_id, await redis.get("test:pending")
+
+    assert asyncio.run(run()) == (None, "abc", b"1")
+
+
+def test_raise_or_lock_limit(redis, backend):
+    async def run():
+        for token in ["a", "b"]:
+            await backend.raise_or_lock_limit(
+                key="test", window=30, limit=2, token=token)
+        await backend.raise_or_lock_limit(key="test", window=30, limit=2)
+
+    with pytest.raises(AlreadyQueued) as e:
+        asyncio.run(run())
+    assert e.value.countdown == approx(15.0, rel=0.1)
+    assert e.value.task_id == "b"
+
+
+def test_clear_lock(redis, backend):
+    async def run():
+        await backend.raise_or_lock(key="test", timeout=60, token="abc")
+        missed = await backend.clear_lock("test", token="def")
+        cleared = await backend.clear_lock("test", token="abc")
+        return missed, cleared, await redis.get("test")
+
+    assert asyncio.run(run()) == (0, 1, None)
+
+
+def test_extend_lock(redis, backend):
+    async def run():
+        await backend.raise_or_lock(key="test", timeout=60, token="abc")
+        extended = await backend.extend_lock("test", 5, "abc")
+        return extended, await redis.pttl("test")
+
+    extended, ttl = asyncio.run(run())
+    assert extended is True
+    assert ttl == approx(5000, rel=0.1)
+
+
+def test_hash_tag(redis, backend):
+    backend.hash_tag = 'once'
+
+    async def run():
+        await backend.raise_or_lock(key="test", timeout=60, token="abc")
+        return await redis.get("{once}test")
+
+    assert asyncio.run(run()) == b"abc"
@@ -1,11 +1,17 @@
 import errno
+import multiprocessing
 import os
 import tempfile
 import time
 
 import pytest
+from celery import Celery
 
-from celery_once.backends.file import key_to_lock_name, File
+from celery_once.backends.file import (
+    key_to_lock_name, lock_name_to_shards, parse_lock_data, setup_sweeper,
+    File, fcntl)
+from celery_once import QueueOnce
+from celery_once.helpers import reset_backends
 from celery_once.tasks import AlreadyQueued
 
 
@@ -60,67 +66,25 @@ def test_file_create_lock(backend, mocker):
     timeout = 3600
     open_mock = mocker.patch('celery_once.backends.file.os.open')
     mtime_mock = mocker.patch('celery_once.backends.file.os.path.getmtime')
-    utime_mock = mocker.patch('celery_once.backends.file.os.utime')
+    write_mock = mocker.patch('celery_once.backends.file.os.write')
     close_mock = mocker.patch('celery_once.backends.file.os.close')
+    mocker.patch('celery_once.backends.file.time.time',
+                 return_value=1550156000.0)
     expected_lock_path = os.path.join(TEST_LOCATION,
                                       key_to_lock_name(key))
-    ret = backend.raise_or_lock(key, timeout)
+    ret = backend.raise_or_lock(key, timeout, token='abc')
 
     assert open_mock.call_count == 1
     assert open_mock.call_args[0] == (
         expected_lock_path,
-        os.O_CREAT | os.O_EXCL,
+        os.O_CREAT | os.O_EXCL | os.O_WRONLY,
     )
-    assert utime_mock.called is False
+    assert mtime_mock.called is False
+    assert write_mock.call_args[0] == (
+        open_mock.return_value, b'1550159600.0 abc')
     assert close_mock.called is True
     assert ret is None
 
-def test_file_lock_exists(backend, mocker):
-    key = 'test.task.key'
-    timeout = 3600
-    open_mock = mocker.patch(
-        'celery_once.backends.file.os.open',
-        side_effect=OSError(errno.EEXIST, 'error'))
-    mtime_mock = mocker.patch(
-        'celery_once.backends.file.os.path.getmtime',
-        return_value=1550155000.0)
-    time_mock = mocker.patch(
-        'celery_once.backends.file.time.time',
-        return_value=1550156000.0)
-    utime_mock = mocker.patch('celery_once.backends.file.os.utime')
-    close_mock = mocker.patch('celery_once.backends.file.os.close')
-    with pytest.raises(AlreadyQueued) as exc_info:
-        backend.raise_or_lock(key, timeout)
-
-    assert open_mock.call_count == 1
-    assert utime_mock.called is False
-    assert close_mock.called is False
-    assert exc_info.value.countdown == timeout - 1000
-
-def test_file_lock_timeout(backend, mocker):
-    key = 'test.task.key'
-    timeout = 3600
-    open_mock = mocker.patch(
-        'celery_once.backends.file.os.open',
-        side_effect=OSError(errno.EEXIST, 'error'))
-    mtime_mock = mocker.patch(
-        'celery_once.backends.file.os.path.getmtime',
-        return_value=1550150000.0)
-    time_mock = mocker.patch(
-        'celery_once.backends.file.time.time',
-        return_value=1550156000.0)
-    utime_mock = mocker.patch('celery_once.backends.file.os.utime')
-    close_mock = mocker.patch('celery_once.backends.file.os.close')
-    expected_lock_path = os.path.join(TEST_LOCATION,
-                                      key_to_lock_name(key))
-    ret = backend.raise_or_lock(key, timeout)
-
-    assert open_mock.call_count == 1
-    assert utime_mock.call_count == 1
-    assert utime_mock.call_args[0] == (expected_lock_path, None)
-    assert close_mock.called is False
-    assert ret is None
-
 def test_file_clear_lock(backend, mocker):
     key = 'test.task.key'
     remove_mock = mocker.patch('celery_once.backends.file.os.remove')
@@ -130,4 +94,397 @@ def test_file_clear_lock(backend, mocker):
 
     assert remove_mock.call_count == 1
     assert remove_mock.call_args[0] == (expected_lock_path,)
-    assert ret is None
+    assert ret is True
+
+
+@pytest.fixture()
+def tmp_backend(tmpdir):
+    return File({'location': str(tmpdir)})
+
+
+def test_file_pending(tmp_backend):
+    tmp_backend.raise_or_lock_pending('test', 60, token='abc')
+    assert tmp_backend.clear_lock_pending('test', token='abc') == (
+        True, False)
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    with pytest.raises(AlreadyQueued) as e:
+        tmp_backend.raise_or_lock_pending('test', 60, token='def')
+    assert e.value.task_id == 'abc'
+    assert sorted(os.listdir(tmp_backend.location)) == [
+        key_to_lock_name('test'), key_to_lock_name('test') + '.pending']
+    assert tmp_backend.clear_lock_pending('test', token='def') == (
+        False, False)
+    assert tmp_backend.clear_lock_pending('test', token='abc') == (
+        True, True)
+    assert os.listdir(tmp_backend.location) == []
+    assert tmp_backend.clear_lock_pending('test') == (False, False)
+
+
+def test_file_pending_expired(tmp_backend, mocker):
+    time_mock = mocker.patch('celery_once.backends.file.time.time',
+                             return_value=1550150000.0)
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    with pytest.raises(AlreadyQueued):
+        tmp_backend.raise_or_lock_pending('test', 60, token='def')
+    time_mock.return_value = 1550150100.0
+    # Taking over drops the mark of the expired owner.
+    tmp_backend.raise_or_lock_pending('test', 60, token='ghi')
+    assert tmp_backend.clear_lock_pending('test', token='ghi') == (
+        True, False)
+
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    with pytest.raises(AlreadyQueued):
+        tmp_backend.raise_or_lock_pending('test', 60, token='def')
+    time_mock.return_value = 1550150200.0
+    assert tmp_backend.sweep() == 1
+    assert os.listdir(tmp_backend.location) == []
+
+
+def test_file_raise_or_lock_limit(tmp_backend, mocker):
+    time_mock = mocker.patch('celery_once.backends.file.time.time',
+                             return_value=1550150000.0)
+    for token in ['a', 'b', 'c']:
+        tmp_backend.raise_or_lock_limit('test', 30, 3, token=token)
+    with pytest.raises(AlreadyQueued) as e:
+        tmp_backend.raise_or_lock_limit('test', 30, 3)
+    # Until the lock expires within 20 seconds, another 10 is allowed.
+    assert e.value.countdown == pytest.approx(10)
+    assert e.value.task_id == 'c'
+    time_mock.return_value = 1550150010.0
+    tmp_backend.raise_or_lock_limit('test', 30, 3, token='d')
+    with tmp_backend._open_lock(tmp_backend._get_lock_path('test')) as lock:
+        assert lock == (pytest.approx(1550150040.0), b'd')
+    with pytest.raises(AlreadyQueued):
+        tmp_backend.raise_or_lock_limit('test', 30, 3)
+    # After the window, the limit is whole again.
+    time_mock.return_value = 1550150040.0
+    for token in ['e', 'f', 'g']:
+        tmp_backend.raise_or_lock_limit('test', 30, 3, token=token)
+
+
+def test_file_clear_lock_token(tmp_backend):
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    assert tmp_backend.clear_lock('test', token='abc') is True
+    assert not os.listdir(tmp_backend.location)
+
+
+def test_file_clear_lock_other_token(tmp_backend):
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    assert tmp_backend.clear_lock('test', token='def') is False
+    with pytest.raises(AlreadyQueued):
+        tmp_backend.raise_or_lock('test', 60, token='def')
+
+
+def test_file_clear_lock_token_missing(tmp_backend):
+    assert tmp_backend.clear_lock('test', token='abc') is False
+
+
+def test_file_clear_lock_expired_and_taken_over(tmp_backend, mocker):
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    mocker.patch('celery_once.backends.file.time.time',
+                 return_value=time.time() + 120)
+    tmp_backend.raise_or_lock('test', 60, token='def')
+    assert tmp_backend.clear_lock('test', token='abc') is False
+    assert tmp_backend.clear_lock('test', token='def') is True
+
+
+def test_file_extend_lock(tmp_backend, mocker):
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    mocker.patch('celery_once.backends.file.time.time',
+                 return_value=time.time() + 120)
+    assert tmp_backend.extend_lock('test', 60, 'abc') is True
+    with pytest.raises(AlreadyQueued):
+        tmp_backend.raise_or_lock('test', 60, token='def')
+
+
+def test_file_extend_lock_other_token(tmp_backend):
+    tmp_backend.raise_or_lock('test', 60, token='def')
+    assert tmp_backend.extend_lock('test', 60, 'abc') is False
+    assert tmp_backend.extend_lock('missing', 60, 'abc') is False
+
+
+def test_parse_lock_data():
+    assert parse_lock_data(b'1550159600.5 abc') == (1550159600.5, b'abc')
+    assert parse_lock_data(b'abc') == (None, b'abc')
+    assert parse_lock_data(b'') == (None, b'')
+
+
+def test_file_extend_lock_expiry(tmp_backend, mocker):
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    mocker.patch('celery_once.backends.file.time.time', return_value=1000.)
+    tmp_backend.extend_lock('test', 60, 'abc')
+    with tmp_backend._open_lock(tmp_backend._get_lock_path('test')) as lock:
+        assert lock == (1060., b'abc')
+    assert os.listdir(tmp_backend.location) == \
+        [key_to_lock_name('test')]
+
+
+def test_file_sweep(tmp_backend, mocker):
+    tmp_backend.raise_or_lock('short', 10, token='abc')
+    tmp_backend.raise_or_lock('long', 3600, token='def')
+    mocker.patch('celery_once.backends.file.time.time',
+                 return_value=time.time() + 60)
+    assert tmp_backend.sweep() == 1
+    assert os.listdir(tmp_backend.location) == [key_to_lock_name('long')]
+    # The expiry was recorded when locking, whatever timeout is used later.
+    with pytest.raises(AlreadyQueued):
+        tmp_backend.raise_or_lock('long', 30, token='def')
+
+
+def test_file_sweep_limit(tmp_backend, mocker):
+    for i in range(5):
+        tmp_backend.raise_or_lock('test%d' % i, 10)
+    mocker.patch('celery_once.backends.file.time.time',
+                 return_value=time.time() + 60)
+    assert tmp_backend.sweep(limit=2) == 2
+    assert tmp_backend.sweep(limit=2) == 2
+    assert tmp_backend.sweep(limit=2) == 1
+    assert tmp_backend.sweep(limit=2) == 0
+    assert os.listdir(tmp_backend.location) == []
+
+
+def test_file_sweep_previous_version(tmp_backend, mocker):
+    tmp_backend.default_timeout = 30
+    with open(tmp_backend._get_lock_path('test'), 'wb') as f:
+        f.write(b'abc')
+    assert tmp_backend.sweep() == 0
+    mocker.patch('celery_once.backends.file.time.time',
+                 return_value=time.time() + 60)
+    assert tmp_backend.sweep() == 1
+
+
+def test_setup_sweeper(tmpdir, mocker):
+    app = Celery()
+    app.conf.ONCE = {
+        'backend': 'celery_once.backends.File',
+        'settings': {'location': str(tmpdir)}
+    }
+    task = setup_sweeper(app, interval=60, limit=10)
+    app.finalize()
+    assert app.conf.beat_schedule['celery_once.sweep_file_locks'] == {
+        'task': 'celery_once.sweep_file_locks',
+        'schedule': 60,
+        'args': (),
+        'kwargs': {},
+        'options': {},
+    }
+    sweep = mocker.patch.object(File, 'sweep', return_value=3)
+    assert task() == 3
+    sweep.assert_called_once_with(10)
+
+
+def test_lock_name_to_shards():
+    lock_name = key_to_lock_name('qo_test')
+    assert lock_name_to_shards(lock_name, 0) == []
+    assert lock_name_to_shards(lock_name, 2) == ['99', '9f']
+
+
+@pytest.fixture()
+def sharded_backend(tmpdir):
+    return File({'location': str(tmpdir), 'shard_depth': 2})
+
+
+def test_file_sharded_lock(sharded_backend, mocker):
+    makedirs = mocker.spy(os, 'makedirs')
+    lock_path = os.path.join(sharded_backend.location, '99', '9f',
+                             key_to_lock_name('qo_test'))
+    assert sharded_backend._get_lock_path('qo_test') == lock_path
+    sharded_backend.raise_or_lock('qo_test', 60, token='abc')
+    assert os.path.isfile(lock_path)
+    with pytest.raises(AlreadyQueued):
+        sharded_backend.raise_or_lock('qo_test', 60, token='def')
+    assert sharded_backend.clear_lock('qo_test', token='abc') is True
+    sharded_backend.raise_or_lock('qo_test', 60, token='def')
+    # The shard directory is created once.
+    assert [c for c in makedirs.call_args_list
+            if c[0][0] == os.path.dirname(lock_path)] == \
+        [mocker.call(os.path.dirname(lock_path))]
+
+
+def test_file_sharded_sweep(sharded_backend, mocker):
+    for i in range(3):
+        sharded_backend.raise_or_lock('test%d' % i, 10)
+    mocker.patch('celery_once.backends.file.time.time',
+                 return_value=time.time() + 60)
+    assert sharded_backend.sweep(limit=2) == 2
+    assert sharded_backend.sweep(limit=2) == 1
+    assert list(sharded_backend._iter_lock_paths()) == []
+
+
+def test_file_migrate(tmpdir):
+    flat = File({'location': str(tmpdir)})
+    flat.raise_or_lock('test1', 60, token='abc')
+    flat.raise_or_lock('test2', 60, token='def')
+    sharded = File({'location': str(tmpdir), 'shard_depth': 2})
+    # Acquired in the sharded layout before the migration.
+    sharded.raise_or_lock('test2', 60, token='ghi')
+    assert sharded.migrate() == 1
+    assert [name for name in os.listdir(str(tmpdir))
+            if os.path.isfile(os.path.join(str(tmpdir), name))] == []
+    assert sharded.clear_lock('test1', token='abc') is True
+    assert sharded.clear_lock('test2', token='ghi') is True
+
+
+def test_file_migrate_flat(tmp_backend):
+    tmp_backend.raise_or_lock('test', 60)
+    assert tmp_backend.migrate() == 0
+    assert os.listdir(tmp_backend.location) == [key_to_lock_name('test')]
+
+
+def test_file_lock_exists(tmp_backend, mocker):
+    time_mock = mocker.patch('celery_once.backends.file.time.time',
+                             return_value=1550155000.0)
+    tmp_backend.raise_or_lock('test', 3600, token='abc')
+    time_mock.return_value = 1550156000.0
+    # The lock expires after the timeout it was acquired with.
+    with pytest.raises(AlreadyQueued) as exc_info:
+        tmp_backend.raise_or_lock('test', 60, token='def')
+    assert exc_info.value.countdown == 2600
+    assert exc_info.value.task_id == 'abc'
+
+
+def test_file_lock_timeout(tmp_backend, mocker):
+    time_mock = mocker.patch('celery_once.backends.file.time.time',
+                             return_value=1550150000.0)
+    tmp_backend.raise_or_lock('test', 3600, token='abc')
+    time_mock.return_value = 1550156000.0
+    assert tmp_backend.raise_or_lock('test', 3600, token='def') is None
+    with tmp_backend._open_lock(tmp_backend._get_lock_path('test')) as lock:
+        assert lock == (1550159600.0, b'def')
+    assert os.listdir(tmp_backend.location) == [key_to_lock_name('test')]
+
+
+def test_file_lock_previous_version(tmp_backend, mocker):
+    with open(tmp_backend._get_lock_path('test'), 'wb') as f:
+        f.write(b'abc')
+    with pytest.raises(AlreadyQueued):
+        tmp_backend.raise_or_lock('test', 60, token='def')
+    mocker.patch('celery_once.backends.file.time.time',
+                 return_value=time.time() + 120)
+    tmp_backend.raise_or_lock('test', 60, token='def')
+    assert tmp_backend.clear_lock('test', token='def') is True
+
+
+def test_file_take_over_replaced(tmp_backend, mocker):
+    """
+    A process finding the lock file replaced once it holds the flock checks
+    the new lock file instead.
+    """
+    lock_path = tmp_backend._get_lock_path('test')
+    mocker.patch('celery_once.backends.file.time.time',
+                 return_value=time.time() + 120)
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    is_same_file = mocker.patch.object(
+        tmp_backend, '_is_same_file', side_effect=[False, True])
+    with pytest.raises(AlreadyQueued):
+        tmp_backend.raise_or_lock('test', 60, token='def')
+    assert is_same_file.call_count == 2
+    assert is_same_file.call_args[0][1] == lock_path
+
+
+def replace_meanwhile(backend, mocker):
+    """
+    Makes the next lock file opened be replaced (by an extend_lock) before
+    its flock is acquired.
+    """
+    flock = fcntl.flock
+    replacing = []
+
+    def extend_meanwhile(fd, operation):
+        if not replacing:
+            replacing.append(fd)
+            assert backend.extend_lock('test', 60, 'abc') is True
+        return flock(fd, operation)
+    return mocker.patch(
+        'celery_once.backends.file.fcntl.flock', side_effect=extend_meanwhile)
+
+
+@pytest.mark.skipif(fcntl is None, reason="Requires fcntl")
+def test_file_clear_lock_replaced(tmp_backend, mocker):
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    replace_meanwhile(tmp_backend, mocker)
+    assert tmp_backend.clear_lock('test', token='abc') is True
+    assert os.listdir(tmp_backend.location) == []
+
+
+@pytest.mark.skipif(fcntl is None, reason="Requires fcntl")
+def test_file_clear_lock_pending_replaced(tmp_backend, mocker):
+    tmp_backend.raise_or_lock('test', 60, token='abc')
+    with pytest.raises(AlreadyQueued):
+        tmp_backend.raise_or_lock_pending('test', 60)
+    replace_meanwhile(tmp_backend, mocker)
+    assert tmp_backend.clear_lock_pending('test', token='abc') == (
+        True, True)
+    assert os.listdir(tmp_backend.location) == []
+
+
+def take_over(location, token, queue):
+    try:
+        File({'location': location}).raise_or_lock('test', 60, token)
+        queue.put(True)
+    except AlreadyQueued:
+        queue.put(False)
+
+
+@pytest.mark.skipif(fcntl is None, reason="Requires fcntl")
+def test_file_take_over_race(tmpdir):
+    """
+    Of many processes taking over an expired lock, only one gets it.
+    """
+    location = str(tmpdir)
+    File({'location': location}).raise_or_lock('test', 0.5, token='abc')
+    time.sleep(0.6)
+    queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=take_over,
+                                args=(location, str(i), queue))
+        for i in range(8)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert sorted(queue.get() for _ in processes) == [False] * 7 + [True]
+
+
+def test_file_rerun_task(tmpdir):
+    app = Celery()
+    app.conf.ONCE = {
+        'backend': 'celery_once.backends.file.File',
+        'settings': {'location': str(tmpdir)},
+    }
+    app.conf.CELERY_ALWAYS_EAGER = True
+    runs = []
+
+    @app.task(name='rerun', base=QueueOnce, once={'rerun': True})
+    def rerun():
+        runs.append(len(runs))
+        if len(runs) == 1:
+            # A burst of triggers while running, coalesced in one rerun.
+            for _ in range(3):
+                with pytest.raises(AlreadyQueued):
+                    rerun.delay()
+
+    reset_backends()
+    rerun.delay()
+    assert runs == [0, 1]
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_file_window_task(tmpdir):
+    app = Celery()
+    app.conf.ONCE = {
+        'backend': 'celery_once.backends.file.File',
+        'settings': {'location': str(tmpdir)},
+    }
+    app.conf.CELERY_ALWAYS_EAGER = True
+
+    @app.task(name='window', base=QueueOnce, once={'window': 60})
+    def window():
+        pass
+
+    reset_backends()
+    window.delay()
+    # Held for the window after it returned.
+    with pytest.raises(AlreadyQueued) as e:
+        window.delay()
+    assert 59 < e.value.countdown <= 60
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+import pytest
+
+import celery_once.backends
+from celery_once.backends.file import File
+from celery_once.backends.redis import Redis
+
+
+def test_backends_attributes():
+    assert celery_once.backends.File is File
+    assert celery_once.backends.Redis is Redis
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="Requires module __dir__ (python 3.7)")
+def test_backends_dir():
+    assert 'SQLite' in dir(celery_once.backends)
+
+
+def test_backends_unknown_attribute():
+    with pytest.raises(AttributeError):
+        celery_once.backends.Unknown
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason="Requires module __getattr__ (python 3.7)")
+def test_backends_file_does_not_import_redis():
+    # In a new interpreter, as this one may have imported redis already.
+    subprocess.check_call([sys.executable, '-c', (
+        "import sys\n"
+        "from celery_once.backends import File\n"
+        "from celery_once.helpers import import_backend\n"
+        "import_backend({'backend': 'celery_once.backends.file.File',"
+        " 'settings': {}})\n"
+        "assert 'redis' not in sys.modules, 'redis imported'\n"
+    )])
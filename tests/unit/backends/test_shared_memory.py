@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+
+import pytest
+
+from celery_once.backends.shared_memory import (
+    DELETED, EMPTY, SLOT, USED, SharedMemory)
+from celery_once.tasks import AlreadyQueued
+
+
+@pytest.fixture()
+def backend(tmpdir):
+    return SharedMemory({'path': str(tmpdir.join('table')),
+                         'slots': 64, 'stripes': 4})
+
+
+def states(backend, stripe):
+    return [SLOT.unpack_from(backend.table, backend._offset(stripe, i))[0]
+            for i in range(backend.stripe_size)]
+
+
+def test_shared_memory_init(backend):
+    assert os.path.getsize(backend.path) == 16 + 64 * 48
+    assert backend.stripe_size == 16
+
+
+def test_shared_memory_init_other_table(backend):
+    with pytest.raises(ValueError):
+        SharedMemory({'path': backend.path, 'slots': 128, 'stripes': 4})
+
+
+def test_shared_memory_init_stripes():
+    with pytest.raises(ValueError):
+        SharedMemory({'slots': 10, 'stripes': 4})
+
+
+def test_shared_memory_raise_or_lock(backend):
+    assert backend.raise_or_lock('test', 60) is None
+    with pytest.raises(AlreadyQueued) as e:
+        backend.raise_or_lock('test', 60)
+    assert 59 < e.value.countdown <= 60
+    backend.raise_or_lock('other', 60)
+
+
+def test_shared_memory_shared(backend):
+    backend.raise_or_lock('test', 60)
+    other = SharedMemory({'path': backend.path, 'slots': 64, 'stripes': 4})
+    with pytest.raises(AlreadyQueued):
+        other.raise_or_lock('test', 60)
+    assert other.clear_lock('test') is True
+    backend.raise_or_lock('test', 60)
+
+
+def test_shared_memory_same_process(backend):
+    """
+    Instances on the same table exclude each other's threads, as record
+    locks do not.
+    """
+    other = SharedMemory({'path': backend.path, 'slots': 64, 'stripes': 4})
+    entered = threading.Event()
+
+    def lock_other():
+        with other._locked(0):
+            entered.set()
+    with backend._locked(0):
+        thread = threading.Thread(target=lock_other)
+        thread.start()
+        assert not entered.wait(0.1)
+    thread.join(1)
+    assert entered.is_set()
+    assert other._thread_locks is backend._thread_locks
+
+
+def test_shared_memory_expired(backend, mocker):
+    backend.raise_or_lock('test', 60, token='abc')
+    mocker.patch('celery_once.backends.shared_memory.time.time',
+                 return_value=time.time() + 120)
+    backend.raise_or_lock('test', 60, token='def')
+    assert backend.clear_lock('test', token='abc') is False
+    assert backend.clear_lock('test', token='def') is True
+
+
+def test_shared_memory_extend_lock(backend, mocker):
+    backend.raise_or_lock('test', 60, token='abc')
+    assert backend.extend_lock('test', 600, 'def') is False
+    assert backend.extend_lock('test', 600, 'abc') is True
+    mocker.patch('celery_once.backends.shared_memory.time.time',
+                 return_value=time.time() + 120)
+    with pytest.raises(AlreadyQueued):
+        backend.raise_or_lock('test', 60)
+    assert backend.extend_lock('missing', 60, 'abc') is False
+
+
+def test_shared_memory_clear_lock_missing(backend):
+    assert backend.clear_lock('test') is False
+
+
+@pytest.fixture()
+def one_stripe(tmpdir):
+    return SharedMemory({'path': str(tmpdir.join('table')),
+                         'slots': 4, 'stripes': 1})
+
+
+def test_shared_memory_probing(one_stripe):
+    keys = ['test%d' % i for i in range(4)]
+    for key in keys:
+        one_stripe.raise_or_lock(key, 60)
+    with pytest.raises(RuntimeError):
+        one_stripe.raise_or_lock('full', 60)
+    for key in keys:
+        with pytest.raises(AlreadyQueued):
+            one_stripe.raise_or_lock(key, 60)
+    assert one_stripe.clear_lock(keys[1]) is True
+    # Keys probed past the deleted slot are still found.
+    for key in keys[:1] + keys[2:]:
+        with pytest.raises(AlreadyQueued):
+            one_stripe.raise_or_lock(key, 60)
+    one_stripe.raise_or_lock('full', 60)
+
+
+def test_shared_memory_full_expired(one_stripe, mocker):
+    for i in range(4):
+        one_stripe.raise_or_lock('test%d' % i, 60)
+    mocker.patch('celery_once.backends.shared_memory.time.time',
+                 return_value=time.time() + 120)
+    one_stripe.raise_or_lock('full', 60)
+
+
+def test_shared_memory_delete(one_stripe, mocker):
+    home = mocker.patch.object(one_stripe, '_locate')
+    home.side_effect = lambda key: (key.encode() * 16, 0, 0)
+    for key in 'abc':
+        one_stripe.raise_or_lock(key, 60)
+    assert states(one_stripe, 0) == [USED, USED, USED, EMPTY]
+    one_stripe.clear_lock('a')
+    one_stripe.clear_lock('b')
+    assert states(one_stripe, 0) == [DELETED, DELETED, USED, EMPTY]
+    # Ending the probe sequence, deleted slots before it are emptied too.
+    one_stripe.clear_lock('c')
+    assert states(one_stripe, 0) == [EMPTY, EMPTY, EMPTY, EMPTY]
+
+
+def test_shared_memory_after_fork(backend, mocker):
+    backend.raise_or_lock('test', 60)
+    thread_locks = backend._thread_locks
+    mocker.patch('celery_once.backends.shared_memory.os.getpid',
+                 return_value=-1)
+    backend.clear_lock('test')
+    assert backend._thread_locks is not thread_locks
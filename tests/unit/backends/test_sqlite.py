@@ -0,0 +1,159 @@
+import sqlite3
+import time
+
+import pytest
+
+from celery_once.backends import sqlite as sqlite_backend
+from celery_once.backends.sqlite import SQLite
+from celery_once.tasks import AlreadyQueued
+
+
+@pytest.fixture(params=[True, False], ids=['returning', 'select'])
+def backend(request, tmpdir, monkeypatch):
+    monkeypatch.setattr(sqlite_backend, 'HAS_RETURNING', request.param)
+    if request.param and sqlite3.sqlite_version_info < (3, 35):
+        pytest.skip('Requires SQLite >= 3.35')
+    return SQLite({'path': str(tmpdir.join('locks.sqlite3')),
+                   'purge_interval': None})
+
+
+def count(backend):
+    return backend.connection.execute(
+        'SELECT COUNT(*) FROM celery_once_locks').fetchone()[0]
+
+
+def test_sqlite_init(backend):
+    assert backend.connection.execute(
+        'PRAGMA journal_mode').fetchone()[0] == 'wal'
+    indexes = backend.connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+    assert ('celery_once_locks_expires_at',) in indexes
+
+
+def test_sqlite_raise_or_lock(backend):
+    assert backend.raise_or_lock('test', 60, token='abc') is None
+    with pytest.raises(AlreadyQueued) as e:
+        backend.raise_or_lock('test', 60)
+    assert 59 < e.value.countdown <= 60
+    assert e.value.task_id == 'abc'
+    backend.raise_or_lock('other', 60)
+    assert count(backend) == 2
+
+
+def test_sqlite_shared(backend):
+    backend.raise_or_lock('test', 60)
+    other = SQLite({'path': backend.path})
+    with pytest.raises(AlreadyQueued):
+        other.raise_or_lock('test', 60)
+
+
+def test_sqlite_expired(backend, mocker):
+    backend.raise_or_lock('test', 60, token='abc')
+    mocker.patch('celery_once.backends.sqlite.time.time',
+                 return_value=time.time() + 120)
+    backend.raise_or_lock('test', 60, token='def')
+    assert backend.clear_lock('test', token='abc') is False
+    assert backend.clear_lock('test', token='def') is True
+    assert backend.clear_lock('test') is False
+
+
+def test_sqlite_extend_lock(backend, mocker):
+    backend.raise_or_lock('test', 60, token='abc')
+    assert backend.extend_lock('test', 600, 'def') is False
+    assert backend.extend_lock('test', 600, 'abc') is True
+    mocker.patch('celery_once.backends.sqlite.time.time',
+                 return_value=time.time() + 120)
+    with pytest.raises(AlreadyQueued):
+        backend.raise_or_lock('test', 60)
+
+
+def test_sqlite_lock_many(backend):
+    backend.raise_or_lock('b', 60)
+    results = backend.lock_many(['a', 'b', 'c'], 60, tokens=['1', '2', '3'])
+    assert results[0] is None
+    assert isinstance(results[1], AlreadyQueued)
+    assert results[2] is None
+    assert backend.clear_lock('a', token='1') is True
+
+
+def test_sqlite_lock_many_rolled_back(backend, mocker):
+    mocker.patch.object(backend, '_acquire', side_effect=[None, ValueError])
+    with pytest.raises(ValueError):
+        backend.lock_many(['a', 'b'], 60)
+    assert count(backend) == 0
+
+
+def test_sqlite_clear_many(backend):
+    backend.lock_many(['a', 'b', 'c'], 60, tokens=['1', '2', '3'])
+    assert backend.clear_many(['a', 'b', 'c', 'd'], ['1', 'x', None, None]) \
+        == [True, False, True, False]
+    assert count(backend) == 1
+
+
+def test_sqlite_purge(backend, mocker):
+    backend.raise_or_lock('short', 10)
+    backend.raise_or_lock('long', 3600)
+    backend.raise_or_lock('other', 10)
+    mocker.patch('celery_once.backends.sqlite.time.time',
+                 return_value=time.time() + 60)
+    assert backend.purge(limit=1) == 1
+    assert backend.purge() == 1
+    assert count(backend) == 1
+
+
+def test_sqlite_purge_interval(backend, mocker):
+    backend.purge_interval = 60
+    purge = mocker.spy(backend, 'purge')
+    backend.raise_or_lock('a', 10)
+    backend.raise_or_lock('b', 10)
+    assert purge.call_count == 1
+    mocker.patch('celery_once.backends.sqlite.time.time',
+                 return_value=time.time() + 120)
+    backend.raise_or_lock('c', 10)
+    assert purge.call_count == 2
+    assert count(backend) == 1
+
+
+def test_sqlite_after_fork(backend, mocker):
+    connection = backend.connection
+    assert backend.connection is connection
+    mocker.patch('celery_once.backends.sqlite.os.getpid', return_value=-1)
+    assert backend.connection is not connection
+
+
+def test_sqlite_pending(backend, mocker):
+    backend.raise_or_lock_pending('test', 60, token='abc')
+    assert backend.clear_lock_pending('test', token='abc') == (True, False)
+    backend.raise_or_lock('test', 60, token='abc')
+    with pytest.raises(AlreadyQueued) as e:
+        backend.raise_or_lock_pending('test', 60)
+    assert e.value.task_id == 'abc'
+    assert backend.clear_lock_pending('test', token='def') == (False, False)
+    assert backend.clear_lock_pending('test', token='abc') == (True, True)
+    assert backend.clear_lock_pending('test') == (False, False)
+
+
+def test_sqlite_pending_purge(backend, mocker):
+    backend.raise_or_lock('test', 60)
+    with pytest.raises(AlreadyQueued):
+        backend.raise_or_lock_pending('test', 60)
+    mocker.patch('celery_once.backends.sqlite.time.time',
+                 return_value=time.time() + 120)
+    backend.purge()
+    assert backend.connection.execute(
+        'SELECT COUNT(*) FROM celery_once_locks_pending').fetchone()[0] == 0
+
+
+def test_sqlite_raise_or_lock_limit(backend, mocker):
+    time_mock = mocker.patch('celery_once.backends.sqlite.time.time',
+                             return_value=1550150000.0)
+    for token in ['a', 'b', 'c']:
+        backend.raise_or_lock_limit('test', 30, 3, token=token)
+    with pytest.raises(AlreadyQueued) as e:
+        backend.raise_or_lock_limit('test', 30, 3)
+    assert e.value.countdown == pytest.approx(10)
+    assert e.value.task_id == 'c'
+    time_mock.return_value = 1550150010.0
+    backend.raise_or_lock_limit('test', 30, 3, token='d')
+    with pytest.raises(AlreadyQueued):
+        backend.raise_or_lock_limit('test', 30, 3)
@@ -0,0 +1,138 @@
+import time
+
+import pytest
+from celery import Celery
+
+from celery_once import QueueOnce
+from celery_once.backends.sqlite import SQLite
+from celery_once.backends.tiered import Tiered
+from celery_once.helpers import reset_backends
+from celery_once.tasks import AlreadyQueued
+
+
+@pytest.fixture()
+def settings(tmpdir):
+    return {
+        'l2_backend': 'celery_once.backends.sqlite.SQLite',
+        'path': str(tmpdir.join('locks.sqlite3')),
+        'l1_timeout': 5,
+    }
+
+
+@pytest.fixture()
+def backend(settings, mocker):
+    backend = Tiered(settings)
+    mocker.spy(backend.l2, 'raise_or_lock')
+    return backend
+
+
+def test_tiered_init(backend, settings):
+    assert isinstance(backend.l2, SQLite)
+    assert backend.l2.path == settings['path']
+    assert backend.l1.max_size == 10000
+
+
+def test_tiered_acquired(backend):
+    backend.raise_or_lock('test', 60, token='abc')
+    with pytest.raises(AlreadyQueued) as e:
+        backend.raise_or_lock('test', 60)
+    assert 59 < e.value.countdown <= 60
+    assert e.value.task_id == 'abc'
+    assert backend.l2.raise_or_lock.call_count == 1
+
+
+def test_tiered_seen_held(backend, settings):
+    Tiered(settings).raise_or_lock('test', 60, token='abc')
+    for _ in range(2):
+        with pytest.raises(AlreadyQueued) as e:
+            backend.raise_or_lock('test', 60)
+        assert 59 < e.value.countdown <= 60
+        assert e.value.task_id == 'abc'
+    assert backend.l2.raise_or_lock.call_count == 1
+
+
+def test_tiered_l1_timeout(backend, settings, mocker):
+    other = Tiered(settings)
+    other.raise_or_lock('test', 60, token='abc')
+    with pytest.raises(AlreadyQueued):
+        backend.raise_or_lock('test', 60)
+    other.clear_lock('test', token='abc')
+    with pytest.raises(AlreadyQueued):
+        backend.raise_or_lock('test', 60)
+    # The L2 is asked again once the L1 entry expired.
+    mocker.patch('celery_once.backends.tiered.time',
+                 return_value=time.time() + 10)
+    backend.raise_or_lock('test', 60)
+    assert backend.l2.raise_or_lock.call_count == 2
+
+
+def test_tiered_clear_lock(backend):
+    backend.raise_or_lock('test', 60, token='abc')
+    assert backend.clear_lock('test', token='abc') is True
+    backend.raise_or_lock('test', 60, token='def')
+    assert backend.l2.raise_or_lock.call_count == 2
+
+
+def test_tiered_extend_lock(backend, mocker):
+    backend.raise_or_lock('test', 1, token='abc')
+    assert backend.extend_lock('test', 60, 'abc') is True
+    assert backend.extend_lock('test', 60, 'def') is False
+    mocker.patch('celery_once.backends.tiered.time',
+                 return_value=time.time() + 2)
+    with pytest.raises(AlreadyQueued):
+        backend.raise_or_lock('test', 60)
+    assert backend.l2.raise_or_lock.call_count == 1
+
+
+def test_tiered_lock_many(backend, mocker):
+    lock_many = mocker.spy(backend.l2, 'lock_many')
+    backend.raise_or_lock('a', 60)
+    Tiered({'l2_backend': 'celery_once.backends.sqlite.SQLite',
+            'path': backend.l2.path}).raise_or_lock('b', 60)
+    results = backend.lock_many(['a', 'b', 'c'], 60)
+    assert isinstance(results[0], AlreadyQueued)
+    assert isinstance(results[1], AlreadyQueued)
+    assert results[2] is None
+    assert lock_many.call_args[0][0] == ['b', 'c']
+    assert isinstance(backend.lock_many(['b', 'c'], 60)[1], AlreadyQueued)
+    assert lock_many.call_count == 1
+
+
+def test_tiered_task_option(settings):
+    reset_backends()
+    app = Celery()
+    app.conf.ONCE = {
+        'backend': 'celery_once.backends.tiered.Tiered',
+        'settings': settings,
+    }
+
+    @app.task(name='tiered', base=QueueOnce)
+    def tiered():
+        pass
+
+    @app.task(name='untiered', base=QueueOnce, once={'l1': False})
+    def untiered():
+        pass
+
+    assert isinstance(tiered.once_backend, Tiered)
+    assert untiered.once_backend is tiered.once_backend.l2
+
+
+def test_tiered_pending(backend):
+    backend.raise_or_lock('test', 60, token='abc')
+    # Asks the L2 despite the L1, to mark the lock pending.
+    with pytest.raises(AlreadyQueued):
+        backend.raise_or_lock_pending('test', 60)
+    assert backend.clear_lock_pending('test', token='abc') == (True, True)
+    assert backend.l1.get('test') is None
+
+
+def test_tiered_raise_or_lock_limit(backend, mocker):
+    mocker.spy(backend.l2, 'raise_or_lock_limit')
+    for _ in range(2):
+        backend.raise_or_lock_limit('test', 30, 2)
+    for _ in range(2):
+        with pytest.raises(AlreadyQueued):
+            backend.raise_or_lock_limit('test', 30, 2)
+    # Held in the L1 since the first rejection.
+    assert backend.l2.raise_or_lock_limit.call_count == 3
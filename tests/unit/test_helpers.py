@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 from celery_once.helpers import (
-    queue_once_key, kwargs_to_list, force_string, import_backend)
+    queue_once_key, kwargs_to_list, force_string, import_backend,
+    get_backend, reset_backends, KeyBuilder, Lease, ExpiringLRU, compact_key,
+    key_digest, takes_token)
 
+import mock
 import pytest
 import six
 
+try:
+    from inspect import signature
+except ImportError:
+    from funcsigs import signature
+
 
 def test_force_string_1():
     assert force_string('a') == 'a'
@@ -105,6 +113,39 @@ def test_queue_once_key_unicode_py3():
     assert key == "qo_éxample_a-é_b-é"
 
 
+
+def test_compact_key_short():
+    assert compact_key('qo_example_a-1', 43, 'qo_example') == 'qo_example_a-1'
+
+
+def test_compact_key():
+    key = queue_once_key('example', {'ids': list(range(1000))})
+    compacted = compact_key(key, 64, 'qo_example')
+    assert len(compacted) == 64
+    assert compacted == (
+        'qo_example_ids-[0, 1, 2, 3, 4, _' + key_digest(key[len('qo_example'):]))
+    assert compact_key(key + '0', 64, 'qo_example') != compacted
+
+
+def test_compact_key_keeps_prefix():
+    key = 'qo_' + 'a' * 100 + '_b-' + 'b' * 100
+    compacted = compact_key(key, 136, 'qo_' + 'a' * 100)
+    assert compacted == (
+        'qo_' + 'a' * 100 + '_' + key_digest('_b-' + 'b' * 100))
+
+
+def test_compact_key_too_short():
+    with pytest.raises(ValueError):
+        compact_key('qo_example_a-1', 42, 'qo_example')
+
+
+def test_compact_key_unicode():
+    key = u"qo_éxample_a-" + u'é' * 100
+    compacted = compact_key(key, 50, u"qo_éxample")
+    assert len(compacted) == 50
+    assert compacted.startswith(u"qo_éxample_a-éééé_")
+
+
 class TestBackend(object):
     def __init__(self, settings):
         self.settings = settings
@@ -118,3 +159,199 @@ def test_import_backend():
     backend = import_backend(config)
     assert backend.settings == 1
 
+
+
+class App(object):
+    pass
+
+
+def test_get_backend():
+    reset_backends()
+    app = App()
+    config = {
+        'backend': "tests.backends.TestBackend",
+        'settings': {'a': 1}
+    }
+    backend = get_backend(app, config)
+    assert backend.settings == {'a': 1}
+    assert get_backend(app, config) is backend
+    assert get_backend(App(), config) is not backend
+
+
+def test_get_backend_config_changed():
+    reset_backends()
+    app = App()
+    config = {
+        'backend': "tests.backends.TestBackend",
+        'settings': {'a': 1}
+    }
+    backend = get_backend(app, config)
+    config['settings']['a'] = 2
+    assert get_backend(app, config) is not backend
+    assert get_backend(app, config).settings == {'a': 2}
+
+
+def example(a, b=2, *args, **kwargs):
+    pass
+
+
+def assert_same_key(func, args, kwargs, restrict_to=None):
+    sig = signature(func)
+    expected = queue_once_key(
+        "example", sig.bind(*args, **kwargs).arguments, restrict_to)
+    assert KeyBuilder("example", sig, restrict_to)(args, kwargs) == expected
+
+
+@pytest.mark.parametrize('args,kwargs', [
+    ((1,), {}),
+    ((1, 'b'), {}),
+    ((1,), {'b': 3}),
+    ((), {'a': 1, 'b': 2}),
+    ((1, 2, 3, 4), {}),
+    ((1,), {'c': 3, 'd': [1, 2]}),
+    ((1, 2, 5), {'z': {'y': 1, 'x': 2}}),
+    (({'b': 1, 'a': {'d': [1, {'f': 1, 'e': 2}], 'c': 1}},), {}),
+    (([1, '2', [3, {'a': '4'}], (5, {'b': 1, 'a': 2})],), {}),
+    (({'a': {1, 2}, 'b': frozenset([3])},), {}),
+    ((u'\xe9', {u'\xe9': [u'\xe9', None, True, 1.5]}), {}),
+    ((list(range(1000)),), {}),
+])
+def test_key_builder_same_as_queue_once_key(args, kwargs):
+    assert_same_key(example, args, kwargs)
+
+
+def test_key_builder_restrict_to():
+    assert_same_key(example, (1, 2), {}, restrict_to=['b'])
+    assert_same_key(example, (1, 2), {}, restrict_to=['b', 'a', 'b'])
+    assert_same_key(example, (1, 2), {}, restrict_to=[])
+
+
+def test_key_builder_max_length():
+    builder = KeyBuilder("example", signature(example), max_length=48)
+    assert builder((1, 2), {}) == 'qo_example_a-1_b-2'
+    key = queue_once_key("example", {'a': list(range(100)), 'b': 2})
+    assert builder((list(range(100)), 2), {}) == \
+        compact_key(key, 48, 'qo_example')
+
+
+def test_key_builder_restrict_to_missing():
+    builder = KeyBuilder("example", signature(example), ['b'])
+    with pytest.raises(KeyError):
+        builder((1,), {})
+
+
+@pytest.mark.parametrize('args,kwargs', [
+    ((), {}),
+    ((1,), {'a': 1}),
+])
+def test_key_builder_invalid_call(args, kwargs):
+    builder = KeyBuilder("example", signature(example))
+    with pytest.raises(TypeError):
+        builder(args, kwargs)
+
+
+def no_var_example(a, b=2):
+    pass
+
+
+def test_key_builder_invalid_call_no_var():
+    builder = KeyBuilder("example", signature(no_var_example))
+    with pytest.raises(TypeError):
+        builder((1, 2, 3), {})
+    with pytest.raises(TypeError):
+        builder((1,), {'c': 3})
+
+
+def test_takes_token(monkeypatch):
+    monkeypatch.setattr('celery_once.helpers._takes_token', {})
+
+    class Backend(object):
+        def raise_or_lock(self, key, timeout, token=None):
+            pass
+
+        def clear_lock(self, key, **kwargs):
+            pass
+
+    class LegacyBackend(object):
+        def raise_or_lock(self, key, timeout):
+            pass
+
+    assert takes_token(Backend().raise_or_lock) is True
+    assert takes_token(Backend().clear_lock) is True
+    assert takes_token(mock.Mock()) is True
+    with pytest.warns(DeprecationWarning):
+        assert takes_token(LegacyBackend().raise_or_lock) is False
+    # Only inspected (and warned about) once.
+    with mock.patch('celery_once.helpers.signature') as signature:
+        assert takes_token(LegacyBackend().raise_or_lock) is False
+    assert signature.called is False
+
+
+def test_lease():
+    backend = mock.Mock()
+    backend.extend_lock.return_value = True
+    lease = Lease(backend, 'key', 'token', 0.03)
+    lease.start()
+    lease.join(0.1)
+    assert lease.is_alive()
+    lease.stop()
+    lease.join(0.1)
+    assert not lease.is_alive()
+    assert backend.extend_lock.call_count > 1
+    backend.extend_lock.assert_called_with('key', 0.03, 'token')
+
+
+def test_lease_lost():
+    backend = mock.Mock()
+    backend.extend_lock.return_value = False
+    lease = Lease(backend, 'key', 'token', 0.03)
+    lease.start()
+    lease.join(0.1)
+    assert not lease.is_alive()
+    assert backend.extend_lock.call_count == 1
+
+
+def test_lease_error(caplog):
+    backend = mock.Mock()
+    errors = [IOError("Unreachable")]
+
+    def extend_lock(key, timeout, token):
+        if errors:
+            raise errors.pop()
+        return True
+    backend.extend_lock.side_effect = extend_lock
+    lease = Lease(backend, 'key', 'token', 0.03)
+    lease.start()
+    lease.join(0.05)
+    assert lease.is_alive()
+    lease.stop()
+    lease.join(0.1)
+    assert not lease.is_alive()
+    assert backend.extend_lock.call_count >= 2
+    assert "Failed to extend the lock key" in caplog.text
+
+
+def test_expiring_lru():
+    cache = ExpiringLRU(2)
+    cache.set('a', 1, expires_at=100)
+    assert cache.get('a', now=99) == 1
+    assert cache.get('a', now=100) is None
+    assert len(cache) == 0
+
+
+def test_expiring_lru_evicts_least_recently_used():
+    cache = ExpiringLRU(2)
+    cache.set('a', 1, expires_at=100)
+    cache.set('b', 2, expires_at=100)
+    assert cache.get('a', now=0) == 1
+    cache.set('c', 3, expires_at=100)
+    assert cache.get('b', now=0) is None
+    assert cache.get('a', now=0) == 1
+    assert cache.get('c', now=0) == 3
+
+
+def test_expiring_lru_pop():
+    cache = ExpiringLRU(2)
+    cache.set('a', 1, expires_at=100)
+    assert cache.pop('a') == 1
+    assert cache.pop('a') is None
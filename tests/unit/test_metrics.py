@@ -0,0 +1,43 @@
+import pytest
+
+from celery_once.metrics import Metrics, PrometheusMetrics
+
+
+def test_metrics_noop():
+    metrics = Metrics({})
+    metrics.lock_acquired('example', 'qo_example')
+    metrics.lock_rejected('example', 'qo_example', 60)
+    metrics.lock_cleared('example', 'qo_example')
+    metrics.lock_clear_missed('example', 'qo_example')
+    metrics.observe('example', 'key', 0.1)
+
+
+def sample(name, **labels):
+    from prometheus_client import REGISTRY
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_prometheus_metrics():
+    pytest.importorskip('prometheus_client')
+    metrics = PrometheusMetrics({'metrics_prefix': 'test_once'})
+    # Initialized again (e.g. the config changed), with the same collectors.
+    assert PrometheusMetrics({'metrics_prefix': 'test_once'}).locks is \
+        metrics.locks
+    metrics.lock_acquired('example', 'qo_example')
+    metrics.lock_acquired('example', 'qo_example')
+    metrics.lock_rejected('example', 'qo_example', 60)
+    metrics.lock_cleared('example', 'qo_example')
+    metrics.lock_clear_missed('example', 'qo_example')
+    metrics.observe('example', 'acquire', 0.002)
+    assert sample('test_once_locks_total', task='example',
+                  result='acquired') == 2
+    assert sample('test_once_locks_total', task='example',
+                  result='rejected') == 1
+    assert sample('test_once_locks_total', task='example',
+                  result='cleared') == 1
+    assert sample('test_once_locks_total', task='example',
+                  result='clear_missed') == 1
+    assert sample('test_once_duration_seconds_count', task='example',
+                  stage='acquire') == 1
+    assert sample('test_once_duration_seconds_bucket', task='example',
+                  stage='acquire', le='0.0025') == 1